@@ -17,43 +17,165 @@
 """See docstring for JSSImporter class."""
 
 from __future__ import absolute_import
+import asyncio
+import hashlib
 import importlib
+import json
 import os
+import plistlib
+import random
+import re
+import shutil
+import struct
+import subprocess
 import sys
+import tempfile
+import threading
 import time
-from collections import OrderedDict
+import unicodedata
+import xml.etree
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from copy import deepcopy
 from distutils.version import StrictVersion
-from zipfile import ZipFile, ZIP_DEFLATED
+from zipfile import BadZipfile, ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
 from xml.sax.saxutils import escape
 
-# ElementTree monkey patch borrowed with love from Matteo Ferla.
-# https://blog.matteoferla.com/2019/02/uniprot-xml-and-python-elementtree.html
-sys.modules.pop("xml.etree.ElementTree", None)
-sys.modules["_elementtree"] = None
-ElementTree = importlib.import_module("xml.etree.ElementTree")
-
-sys.path.insert(0, "/Library/AutoPkg/JSSImporter")
-
-import jss  # pylint: disable=import-error
-
-# Ensure that python-jss dependency is at minimum version
-try:
-    from jss import __version__ as PYTHON_JSS_VERSION
-except ImportError:
-    PYTHON_JSS_VERSION = "0.0.0"
-
 from autopkglib import Processor, ProcessorError  # pylint: disable=import-error
 
 
 __all__ = ["JSSImporter"]
 __version__ = "1.1.6"
 REQUIRED_PYTHON_JSS_VERSION = StrictVersion("2.1.1")
+JSS_IMPORT_PATH = "/Library/AutoPkg/JSSImporter"
+
+# python-jss and the pure Python ElementTree it is imported with, once
+# they have been loaded by load_jss().
+JSS_MODULES = []
+JSS_MODULES_LOCK = threading.Lock()
+COOKIE_JAR = "/tmp/pythonjss_cookie_jar"
+HASH_CHUNK_SIZE = 1024 * 1024
+# S3 rejects multipart uploads with smaller parts, except for the last.
+MIN_UPLOAD_CHUNK_SIZE = 5 * 1024 * 1024
+ZIP_FINGERPRINT_PREFIX = "JSSImporter fingerprint: "
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+STATE_DIR = os.path.expanduser("~/Library/AutoPkg/JSSImporter")
+STATE_FILE_LOCK = threading.Lock()
+
+# Compiled templates, keyed by path, with the mtime and size of the file
+# they were compiled from and the digest of its contents.
+TEMPLATE_CACHE = {}
+TEMPLATE_CACHE_LOCK = threading.Lock()
+
+# Parsed templates, keyed by the digest of their contents, or None for
+# templates which must be rendered as text.
+TEMPLATE_SKELETONS = {}
+PLACEHOLDER_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+XML_COMMENT_RE = re.compile(r"<!--.*?-->", re.DOTALL)
+# Characters which may not appear in an XML 1.0 document at all.
+XML_INVALID_CHAR_RE = re.compile(
+    "[^\t\n\r\u0020-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]"
+)
+
+# Jamf Pro package hash_type values and their hashlib equivalents.
+PACKAGE_HASH_ALGORITHMS = {"MD5": "md5", "SHA_256": "sha256", "SHA_512": "sha512"}
+
+# JSS objects shared by all JSSImporter instances in this process when
+# JSS_REUSE_SESSION is set, keyed by (JSS_URL, API_USERNAME).
+JSS_SESSIONS = {}
+JSS_SESSIONS_LOCK = threading.Lock()
+
+# The JSSImporter whose metrics requests made in this thread count towards.
+METRICS_CONTEXT = threading.local()
+
+# Held while an icon is looked up in the icon registry and uploaded, so
+# that recipes processed together upload a shared icon only once.
+ICON_LOCK = threading.Lock()
+
+# Held while a category is looked up or created, so that objects handled
+# at the same time, even by different recipes, can't create it twice.
+CATEGORY_LOCK = threading.Lock()
+
+# Objects listed from each Jamf Pro server, shared by all JSSImporter
+# instances in this process, keyed by (JSS_URL, python-jss class name).
+INVENTORY_CACHE = {}
+INVENTORY_CACHE_LOCK = threading.Lock()
+PRELOAD_TYPES = (
+    "Category",
+    "ComputerGroup",
+    "Script",
+    "ComputerExtensionAttribute",
+    "Policy",
+    "Package",
+)
 
 # Map Python 2 basestring type for Python 3.
 if sys.version_info.major == 3:
     basestring = str
 
 
+def load_jss():
+    """Import python-jss, with the pure Python ElementTree.
+
+    python-jss objects subclass ElementTree.Element, which needs the
+    pure Python implementation. It is only forced on python-jss, and on
+    the ElementTree used here with python-jss objects; the C
+    implementation is put back for everything else in the process.
+
+    Returns:
+        A list of the jss module and the ElementTree module it uses.
+    """
+    with JSS_MODULES_LOCK:
+        if JSS_MODULES:
+            return JSS_MODULES
+        saved = {
+            name: sys.modules.get(name)
+            for name in ("xml.etree.ElementTree", "_elementtree")
+        }
+        saved_attribute = xml.etree.__dict__.get("ElementTree")
+        # ElementTree monkey patch borrowed with love from Matteo Ferla.
+        # https://blog.matteoferla.com/2019/02/uniprot-xml-and-python-elementtree.html
+        sys.modules.pop("xml.etree.ElementTree", None)
+        sys.modules["_elementtree"] = None
+        try:
+            if JSS_IMPORT_PATH not in sys.path:
+                sys.path.insert(0, JSS_IMPORT_PATH)
+            jss_module = importlib.import_module("jss")
+            # python-jss may import its own copy of the module, and
+            # elements must be made with the one its objects check for.
+            element_tree = importlib.import_module("jss.jssobject").ElementTree
+        finally:
+            for name, module in saved.items():
+                if module is None:
+                    sys.modules.pop(name, None)
+                else:
+                    sys.modules[name] = module
+            if saved_attribute is None:
+                xml.etree.__dict__.pop("ElementTree", None)
+            else:
+                xml.etree.ElementTree = saved_attribute
+        JSS_MODULES.extend([jss_module, element_tree])
+        return JSS_MODULES
+
+
+class LazyModule(object):  # pylint: disable=too-few-public-methods
+    """A module which is only imported when one of its names is used."""
+
+    def __init__(self, loader):
+        """Keep the function that imports and returns the module."""
+        self._loader = loader
+
+    def __getattr__(self, name):
+        """Import the module if needed, and return its attribute."""
+        return getattr(self._loader(), name)
+
+
+jss = LazyModule(lambda: load_jss()[0])  # pylint: disable=invalid-name
+ElementTree = LazyModule(lambda: load_jss()[1])  # pylint: disable=invalid-name
+
+
 # pylint: disable=too-many-instance-attributes, too-many-public-methods
 class JSSImporter(Processor):
     """Uploads packages to configured Casper distribution points.
@@ -289,6 +411,265 @@ class JSSImporter(Processor):
             "default": False,
             "description": "If True, policy scripts will not be updated.",
         },
+        "JSS_WAIT_INITIAL_DELAY": {
+            "required": False,
+            "default": 0.25,
+            "description": "Seconds to wait before re-checking that an object "
+            "saved to the Jamf Pro server has been assigned an ID. The delay "
+            "doubles after each check, up to JSS_WAIT_MAX_DELAY. Defaults to "
+            "'0.25'.",
+        },
+        "JSS_WAIT_MAX_DELAY": {
+            "required": False,
+            "default": 10,
+            "description": "Maximum number of seconds to wait between checks "
+            "that an object has been assigned an ID. Defaults to '10'.",
+        },
+        "JSS_WAIT_JITTER": {
+            "required": False,
+            "default": 0.25,
+            "description": "Fraction by which each wait between ID checks is "
+            "randomly lengthened or shortened, so that clustered servers are "
+            "not polled in lockstep. Defaults to '0.25'.",
+        },
+        "JSS_WAIT_TIMEOUT": {
+            "required": False,
+            "default": 120,
+            "description": "Number of seconds to keep checking for an object "
+            "ID before giving up. Defaults to '120'.",
+        },
+        "JSS_WAIT_TIMEOUTS": {
+            "required": False,
+            "default": {},
+            "description": "Dictionary of per-object-type ID check timeouts "
+            "in seconds, overriding JSS_WAIT_TIMEOUT, e.g. "
+            "{'Package': 600, 'Category': 30}. Keys are python-jss class "
+            "names.",
+        },
+        "JSS_COPY_CONCURRENCY": {
+            "required": False,
+            "default": 1,
+            "description": "Number of distribution points to copy packages "
+            "to at the same time. Each distribution point is copied to by its "
+            "own worker. Defaults to '1', which copies to each distribution "
+            "point in turn.",
+        },
+        "JSS_REUSE_SESSION": {
+            "required": False,
+            "default": False,
+            "description": "If True, the connection to the Jamf Pro server, "
+            "including its cookies, is kept and reused by every JSSImporter "
+            "run in the same AutoPkg process for the same JSS_URL and "
+            "API_USERNAME. Defaults to 'False'.",
+        },
+        "JSS_SESSION_MAX_AGE": {
+            "required": False,
+            "default": 1800,
+            "description": "Number of seconds after which a reused Jamf Pro "
+            "session is discarded and a new one started. Defaults to '1800'.",
+        },
+        "JSS_PRELOAD_INVENTORY": {
+            "required": False,
+            "default": False,
+            "description": "If True, the names and IDs of all categories, "
+            "computer groups, scripts, extension attributes, policies and "
+            "packages are listed once at the start, and used to tell whether "
+            "an object exists without asking the server. Defaults to 'False'.",
+        },
+        "JSS_INVENTORY_CACHE_TTL": {
+            "required": False,
+            "default": 300,
+            "description": "Number of seconds for which the objects listed "
+            "with JSS_PRELOAD_INVENTORY are shared between recipes in the same "
+            "AutoPkg run. Defaults to '300'.",
+        },
+        "JSS_CATEGORY_CACHE_TTL": {
+            "required": False,
+            "default": 300,
+            "description": "Number of seconds for which the list of categories "
+            "on the Jamf Pro server is cached and shared between recipes in "
+            "the same AutoPkg run. Set to '0' to look up categories "
+            "individually every time. Defaults to '300'.",
+        },
+        "JSS_ZIP_COMPRESSION": {
+            "required": False,
+            "default": "",
+            "description": "Compression level from '0' to '9' used when "
+            "zipping bundle packages, or 'store' to add files without "
+            "compression. Defaults to the zlib default level.",
+        },
+        "JSS_ZIP_WORKERS": {
+            "required": False,
+            "default": 0,
+            "description": "Number of files in a bundle package compressed at "
+            "the same time when it is zipped. '1' compresses them one after "
+            "another. Defaults to '0', which uses one per CPU.",
+        },
+        "JSS_ZIP_REUSE": {
+            "required": False,
+            "default": True,
+            "description": "If True, a zip of a bundle package made by an "
+            "earlier run is reused when the bundle's contents have not "
+            "changed. Defaults to 'True'.",
+        },
+        "JSS_UPLOAD_ON_HASH_CHANGE": {
+            "required": False,
+            "default": False,
+            "description": "If True, a package that is already on the "
+            "distribution points is uploaded again when its checksum differs "
+            "from the one on the Jamf Pro package record, or, if that has "
+            "none, the one recorded locally when it was last uploaded. For "
+            "file share repos the local record is checked first, and the "
+            "package record's checksum is updated after each upload. "
+            "Defaults to 'False'.",
+        },
+        "JSS_PACKAGE_HASH_MANIFEST": {
+            "required": False,
+            "default": "",
+            "description": "Path to the JSON file in which the checksums of "
+            "uploaded packages are recorded, for each JSS_URL and distribution "
+            "point. Defaults to "
+            "'~/Library/AutoPkg/JSSImporter/package_hashes.json'.",
+        },
+        "JSS_UPLOAD_RETRIES": {
+            "required": False,
+            "default": 0,
+            "description": "Number of times to retry copying a package to a "
+            "distribution point after a failure, waiting longer after each "
+            "attempt. Defaults to '0'.",
+        },
+        "JSS_UPLOAD_CHECKPOINT": {
+            "required": False,
+            "default": False,
+            "description": "If True, each distribution point that has received "
+            "a package is recorded in "
+            "'~/Library/AutoPkg/JSSImporter/upload_checkpoint.json', so that "
+            "an interrupted upload resumes with the distribution points that "
+            "have not. With JSS_UPLOAD_CHUNK_SIZE, the parts acknowledged by "
+            "AWS distribution points are recorded too. Defaults to 'False'.",
+        },
+        "JSS_UPLOAD_CHUNK_SIZE": {
+            "required": False,
+            "default": 0,
+            "description": "If more than 0, packages are uploaded to AWS "
+            "distribution points with an S3 multipart upload, in parts of this "
+            "many bytes, which must be at least 5242880. A retried upload only "
+            "sends the parts the bucket has not acknowledged, and with "
+            "JSS_UPLOAD_CHECKPOINT, so does the next run after an interrupted "
+            "upload. 0 uploads each package in a single request through "
+            "python-jss. Defaults to '0'.",
+        },
+        "JSS_UPLOAD_PART_CONCURRENCY": {
+            "required": False,
+            "default": 4,
+            "description": "With JSS_UPLOAD_CHUNK_SIZE, the number of parts of "
+            "a package uploaded at the same time. Defaults to '4'.",
+        },
+        "JSS_OBJECT_CONCURRENCY": {
+            "required": False,
+            "default": 1,
+            "description": "Number of extension attributes, groups and "
+            "scripts to create or update at the same time before the policy "
+            "is assembled. Defaults to '1', which handles them one after "
+            "another.",
+        },
+        "JSS_EXECUTION_BACKEND": {
+            "required": False,
+            "default": "threads",
+            "description": "How objects are processed at the same time when "
+            "JSS_OBJECT_CONCURRENCY is more than 1: 'threads' waits on a "
+            "thread pool, 'asyncio' runs each object as a task on an asyncio "
+            "event loop, limited by a semaphore, with its python-jss calls "
+            "in a thread pool. python-jss calls block, so both make the same "
+            "requests, as many at a time, through the shared python-jss "
+            "session. Defaults to 'threads'.",
+        },
+        "JSS_DRY_RUN": {
+            "required": False,
+            "default": False,
+            "description": "If True, the whole workflow is run using only read "
+            "requests. Nothing is saved or uploaded; instead, the changes that "
+            "would be made are reported in jss_importer_plan. Defaults to "
+            "'False'.",
+        },
+        "JSS_METRICS_FILE": {
+            "required": False,
+            "default": "",
+            "description": "Path to a file to which jss_importer_metrics is "
+            "appended as a line of JSON after each run, for tracking "
+            "performance over time.",
+        },
+        "JSS_STATE_CACHE": {
+            "required": False,
+            "default": False,
+            "description": "If True, the version, package checksum, rendered "
+            "templates, icon and settings of each successful run are recorded "
+            "locally with the IDs of the objects published. A later run of the "
+            "same recipe with identical inputs finishes without connecting to "
+            "the Jamf Pro server. Defaults to 'False'.",
+        },
+        "JSS_STATE_VERIFY_INTERVAL": {
+            "required": False,
+            "default": 86400,
+            "description": "With JSS_STATE_CACHE, seconds after which a recipe "
+            "is run in full against the server even if its inputs are "
+            "unchanged, to correct changes made on the server. 0 never forces "
+            "a full run. Defaults to '86400'.",
+        },
+        "JSS_ICON_REGISTRY": {
+            "required": False,
+            "default": False,
+            "description": "If True, the checksum of each uploaded Self Service "
+            "icon is recorded locally with its ID on the Jamf Pro server. A "
+            "policy given an icon with the same content, under any filename, "
+            "then uses the existing icon instead of uploading it again. "
+            "Defaults to 'False'.",
+        },
+        "JSS_OPTIMIZE_ICONS": {
+            "required": False,
+            "default": False,
+            "description": "If True, PNG Self Service icons larger than "
+            "JSS_ICON_MAX_SIZE are downscaled, using Pillow or sips, and "
+            "losslessly recompressed before they are uploaded. Optimized icons "
+            "are cached locally by checksum. Defaults to 'False'.",
+        },
+        "JSS_ICON_MAX_SIZE": {
+            "required": False,
+            "default": 512,
+            "description": "With JSS_OPTIMIZE_ICONS, the largest width or height "
+            "in pixels of an uploaded icon. Defaults to '512'.",
+        },
+        "JSS_STREAMING_COPY": {
+            "required": False,
+            "default": False,
+            "description": "If True, packages are copied to mounted file share "
+            "distribution points (AFP, SMB and Local) by JSSImporter itself: "
+            "the package is hashed as it is copied, written to a temporary "
+            "file, checked against the hash on the share and then renamed into "
+            "place. Defaults to 'False'.",
+        },
+        "JSS_COPY_BUFFER_SIZE": {
+            "required": False,
+            "default": 8388608,
+            "description": "With JSS_STREAMING_COPY, the number of bytes read "
+            "and written at a time, rounded up to a multiple of 64 KiB. "
+            "Defaults to '8388608'.",
+        },
+        "JSS_COPY_BANDWIDTH_LIMIT": {
+            "required": False,
+            "default": 0,
+            "description": "With JSS_STREAMING_COPY, the maximum speed of each "
+            "copy in megabytes per second. 0 is unlimited. Defaults to '0'.",
+        },
+        "JSS_PIPELINE_UPLOAD": {
+            "required": False,
+            "default": False,
+            "description": "If True, once JSSImporter has decided that the "
+            "package must be uploaded, the upload runs in the background while "
+            "extension attributes, groups and scripts are processed and the "
+            "policy is rendered. The upload is finished before the policy is "
+            "saved. Defaults to 'False'.",
+        },
     }
     output_variables = {
         "jss_changed_objects": {
@@ -297,6 +678,16 @@ class JSSImporter(Processor):
         "jss_importer_summary_result": {
             "description": "Description of interesting results."
         },
+        "jss_importer_metrics": {
+            "description": "Wall time per phase, requests to the Jamf Pro server "
+            "counted by method and endpoint with their time and bytes, and "
+            "time spent waiting for object IDs. Phases may overlap."
+        },
+        "jss_importer_plan": {
+            "description": "With JSS_DRY_RUN, the objects that would be created "
+            "and updated, the files that would be uploaded, the total bytes to "
+            "upload and the number of write requests."
+        },
     }
     description = __doc__
 
@@ -317,14 +708,42 @@ class JSSImporter(Processor):
         self.scripts = None
         self.policy = None
         self.upload_needed = False
+        self.upload_future = None
+        # run_batch mounts the distribution points for all its recipes.
+        self.manage_mounts = True
+        self.mounted_dps = []
+        self.pkg_hashes = {}
+        self.upload_parts = {}
+        self.category_lock = CATEGORY_LOCK
+        self.dir_listings = {}
+        self.metrics = {
+            "phases": {},
+            "requests": {},
+            "polling": {"checks": 0, "sleep_seconds": 0.0},
+            "templates": {"hits": 0, "misses": 0, "text": 0},
+        }
+        self.metrics_lock = threading.Lock()
 
-        #  clear any cookies since we want a new session
-        cookiejar = "/tmp/pythonjss_cookie_jar"
-        if os.path.isfile(cookiejar):
-            os.remove(cookiejar)
+    def get_bool(self, key):
+        """Return the env value for key as a boolean.
+
+        Values set with `-k` on the command line arrive as strings, so
+        'False', 'No' and '0' are treated as False.
+        """
+        value = self.env.get(key)
+        if isinstance(value, basestring):
+            return value.strip().lower() not in ("", "false", "no", "0")
+        return bool(value)
 
     def create_jss(self):
-        """Create a JSS object for API calls"""
+        """Create a JSS object for API calls
+
+        If JSS_REUSE_SESSION is set, a JSS object created earlier in
+        this process for the same JSS_URL and API_USERNAME is reused,
+        keeping its connection pool and cookies. It is replaced if any
+        other connection setting, such as the password, has changed, or
+        if it is older than JSS_SESSION_MAX_AGE.
+        """
         kwargs = {
             "url": self.env["JSS_URL"],
             "user": self.env["API_USERNAME"],
@@ -332,9 +751,85 @@ class JSSImporter(Processor):
             "ssl_verify": self.env["JSS_VERIFY_SSL"],
             "repo_prefs": self.env["JSS_REPOS"],
         }
-        self.jss = jss.JSS(**kwargs)
-        if self.env.get("verbose", 1) >= 4:
-            self.jss.verbose = True
+        reuse = self.get_bool("JSS_REUSE_SESSION")
+        key = (kwargs["url"], kwargs["user"])
+        fingerprint = hashlib.sha256(
+            json.dumps(kwargs, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+
+        with JSS_SESSIONS_LOCK:
+            cached = JSS_SESSIONS.get(key) if reuse else None
+            if cached is not None:
+                cached_fingerprint, created, cached_jss = cached
+                if cached_fingerprint != fingerprint:
+                    self.output(
+                        "Connection settings have changed, starting a new "
+                        "Jamf Pro session.",
+                        verbose_level=2,
+                    )
+                elif time.time() - created > self.get_number("JSS_SESSION_MAX_AGE"):
+                    self.output(
+                        "Jamf Pro session has expired, starting a new one.",
+                        verbose_level=2,
+                    )
+                else:
+                    self.output("Reusing Jamf Pro session.", verbose_level=2)
+                    self.jss = cached_jss
+                    return
+
+            # clear any cookies since we want a new session
+            if os.path.isfile(COOKIE_JAR):
+                os.remove(COOKIE_JAR)
+            self.jss = jss.JSS(**kwargs)
+            if self.env.get("verbose", 1) >= 4:
+                self.jss.verbose = True
+            if reuse:
+                JSS_SESSIONS[key] = (fingerprint, time.time(), self.jss)
+
+    def init_plan(self):
+        """Build a dictionary to record the writes a dry run would make."""
+        self.env["jss_importer_plan"] = {
+            "creates": [],
+            "updates": [],
+            "uploads": [],
+            "bytes_to_upload": 0,
+            "api_writes": 0,
+        }
+
+    def save_object(self, obj):
+        """Save an object to the server, or in a dry run, plan to."""
+        if not self.get_bool("JSS_DRY_RUN"):
+            obj.save()
+            return
+        action = "updates" if self.get_object_id(obj) else "creates"
+        entry = {"type": obj.__class__.__name__, "name": obj.name}
+        plan = self.env["jss_importer_plan"]
+        if entry not in plan[action]:
+            plan[action].append(entry)
+            plan["api_writes"] += 1
+        self.output(
+            "Dry run: would {} {} '{}'.".format(action[:-1], entry["type"], obj.name)
+        )
+
+    def plan_upload(self, upload_type, path, destinations=1):
+        """Record a file upload that a dry run would make."""
+        size = os.path.getsize(path)
+        plan = self.env["jss_importer_plan"]
+        plan["uploads"].append(
+            {
+                "type": upload_type,
+                "name": os.path.basename(path),
+                "bytes": size,
+                "destinations": destinations,
+            }
+        )
+        plan["bytes_to_upload"] += size * destinations
+        plan["api_writes"] += destinations
+        self.output(
+            "Dry run: would upload {} '{}' ({} bytes) to {} destination(s).".format(
+                upload_type, os.path.basename(path), size, destinations
+            )
+        )
 
     def init_jss_changed_objects(self):
         """Build a dictionary to track changes to JSS objects."""
@@ -343,6 +838,7 @@ class JSSImporter(Processor):
             "jss_category_added",
             "jss_package_added",
             "jss_package_updated",
+            "jss_package_fields_updated",
             "jss_group_added",
             "jss_group_updated",
             "jss_script_added",
@@ -366,16 +862,81 @@ class JSSImporter(Processor):
             return
         return repo
 
-    def wait_for_id(self, obj_cls, obj_name):
-        """wait for feedback that the object is there"""
-        object = None
+    def get_number(self, key):
+        """Return the env value for key as a float.
+
+        Values set with `-k` on the command line arrive as strings, so
+        they are converted here. Falls back to the input variable's
+        default if the value cannot be converted.
+        """
+        try:
+            return float(self.env.get(key))
+        except (TypeError, ValueError):
+            return float(self.input_variables[key]["default"])
+
+    def get_object_id(self, obj):  # pylint: disable=no-self-use
+        """Return the ID of a JSS object, or 0 if it has none yet."""
+        try:
+            return int(obj.id)
+        except (AttributeError, TypeError, ValueError):
+            return 0
+
+    def get_wait_timeout(self, obj_cls):
+        """Return the ID check timeout in seconds for an object type."""
+        timeouts = self.env.get("JSS_WAIT_TIMEOUTS") or {}
+        try:
+            return float(timeouts[obj_cls.__name__])
+        except (KeyError, TypeError, ValueError):
+            return self.get_number("JSS_WAIT_TIMEOUT")
+
+    def wait_delays(self):
+        """Generate exponentially increasing delays with jitter.
+
+        Delays start at JSS_WAIT_INITIAL_DELAY and double on each
+        iteration up to JSS_WAIT_MAX_DELAY. Each delay is randomly
+        varied by the JSS_WAIT_JITTER fraction.
+        """
+        delay = self.get_number("JSS_WAIT_INITIAL_DELAY")
+        max_delay = self.get_number("JSS_WAIT_MAX_DELAY")
+        jitter = self.get_number("JSS_WAIT_JITTER")
+        while True:
+            yield max(0, delay * random.uniform(1 - jitter, 1 + jitter))
+            delay = min(delay * 2, max_delay)
+
+    def wait_for_id(self, obj_cls, obj_name, saved_object=None):
+        """wait for feedback that the object is there
+
+        If saved_object already carries the ID that the server returned
+        when it was saved, no polling is needed and it is returned
+        straight away. Otherwise, the server is polled with exponential
+        backoff until the object reports an ID, or the timeout for this
+        object type expires, in which case None is returned.
+        """
+        if self.get_bool("JSS_DRY_RUN"):
+            # Nothing was saved, so there is no ID to wait for.
+            if saved_object is None:
+                saved_object = obj_cls(self.jss, obj_name)
+            self.upload_needed = True
+            return saved_object
+
+        if saved_object is not None and self.get_object_id(saved_object):
+            self.output(
+                "{} ID '{}' returned by server".format(
+                    obj_cls.__name__, saved_object.id
+                ),
+                verbose_level=2,
+            )
+            self.upload_needed = True
+            return saved_object
+
         search_method = getattr(self.jss, obj_cls.__name__)
-        # limit time to wait to get a package ID.
-        timeout = time.time() + 120
+        # limit time to wait to get an ID.
+        timeout = time.time() + self.get_wait_timeout(obj_cls)
+        delays = self.wait_delays()
         while time.time() < timeout:
             try:
                 object = search_method(obj_name)
-                if object.id != 0:
+                if self.get_object_id(object):
                     self.output(
                         "{} ID '{}' verified on server".format(
                             obj_cls.__name__, object.id
@@ -384,72 +945,178 @@ class JSSImporter(Processor):
                     )
                     self.upload_needed = True
                     return object
-                else:
-                    self.output(
-                        "Waiting to get {} ID from server (reported: {})...".format(
-                            obj_cls.__name__, object.id
-                        ),
-                        verbose_level=2,
-                    )
-                    time.sleep(10)
+                reported = object.id
             except jss.GetError:
+                reported = "none"
+            self.output(
+                "Waiting to get {} ID from server (reported: {})...".format(
+                    obj_cls.__name__, reported
+                ),
+                verbose_level=2,
+            )
+            delay = max(0, min(next(delays), timeout - time.time()))
+            with self.metrics_lock:
+                self.metrics["polling"]["checks"] += 1
+                self.metrics["polling"]["sleep_seconds"] += delay
+            time.sleep(delay)
+
+    def get_inventory(self, type_name, ttl):
+        """Return the listed objects of one type, keyed by lowercase name.
+
+        The objects are fetched from the type's list endpoint in a
+        single request, and shared by every JSSImporter in this process
+        until they are older than ttl seconds. They only carry the
+        object's name and ID.
+
+        Returns:
+            A dict, or None if the list could not be fetched.
+        """
+        key = (self.env["JSS_URL"], type_name)
+        with INVENTORY_CACHE_LOCK:
+            cached = INVENTORY_CACHE.get(key)
+            if cached is None or time.time() - cached[0] > ttl:
+                try:
+                    objects = {
+                        listed.name.lower(): listed
+                        for listed in getattr(self.jss, type_name)()
+                    }
+                except jss.GetError:
+                    return None
                 self.output(
-                    "Waiting to get {} ID from server (none reported)...".format(
-                        obj_cls.__name__
+                    "Listed {} {} objects on the Jamf Pro server.".format(
+                        len(objects), type_name
                     ),
-                    verbose_level=2,
+                    verbose_level=3,
                 )
-                time.sleep(10)
+                cached = (time.time(), objects)
+                INVENTORY_CACHE[key] = cached
+            return cached[1]
+
+    def get_inventory_ttl(self, type_name):
+        """Return how long listed objects of a type are used, or 0 if not."""
+        ttl = 0
+        if type_name == "Category":
+            ttl = self.get_number("JSS_CATEGORY_CACHE_TTL")
+        if self.get_bool("JSS_PRELOAD_INVENTORY") and type_name in PRELOAD_TYPES:
+            ttl = max(ttl, self.get_number("JSS_INVENTORY_CACHE_TTL"))
+        return ttl
+
+    def preload_inventory(self):
+        """List all objects of the types JSSImporter works with."""
+        for type_name in PRELOAD_TYPES:
+            self.get_inventory(type_name, self.get_inventory_ttl(type_name))
+
+    def add_to_inventory(self, obj):
+        """Add an object created by JSSImporter to the listed objects.
+
+        The listed objects are shared with other recipes, so objects
+        which a dry run only plans to create are left out.
+        """
+        if self.get_bool("JSS_DRY_RUN"):
+            return
+        key = (self.env["JSS_URL"], obj.__class__.__name__)
+        with INVENTORY_CACHE_LOCK:
+            if key in INVENTORY_CACHE:
+                INVENTORY_CACHE[key][1][obj.name.lower()] = obj
+
+    def get_object(self, obj_cls, name):
+        """Return an object from the server by name.
+
+        If JSS_PRELOAD_INVENTORY is set, names missing from the listed
+        objects are known not to exist without asking the server, and
+        existing objects are fetched by ID.
+
+        Raises:
+            jss.GetError if the object does not exist.
+        """
+        search_method = getattr(self.jss, obj_cls.__name__)
+        if self.get_bool("JSS_PRELOAD_INVENTORY") and obj_cls.__name__ in PRELOAD_TYPES:
+            inventory = self.get_inventory(
+                obj_cls.__name__, self.get_inventory_ttl(obj_cls.__name__)
+            )
+            if inventory is not None:
+                listed = inventory.get(name.lower())
+                if listed is None:
+                    raise jss.GetError(
+                        "{} '{}' does not exist.".format(obj_cls.__name__, name)
+                    )
+                if self.get_object_id(listed):
+                    return search_method(self.get_object_id(listed))
+        return search_method(name)
+
+    def get_category(self, category_name):
+        """Return a category, from the listed categories if possible.
+
+        Categories missing from the list are looked up on the server in
+        case they were created since it was fetched.
+
+        Raises:
+            jss.GetError if the category does not exist.
+        """
+        ttl = self.get_inventory_ttl("Category")
+        inventory = self.get_inventory("Category", ttl) if ttl > 0 else None
+        if inventory is not None and category_name.lower() in inventory:
+            return inventory[category_name.lower()]
+        category = self.jss.Category(category_name)
+        self.add_to_inventory(category)
+        return category
 
     def handle_category(self, category_type, category_name=None):
         """Ensure a category is present."""
-        if self.env.get(category_type):
-            category_name = self.env.get(category_type)
+        # Objects may be handled at the same time, and must not race to
+        # create the same category.
+        with self.category_lock:
+            if self.env.get(category_type):
+                category_name = self.env.get(category_type)
 
-        if category_name is not None:
-            try:
-                category = self.jss.Category(category_name)
-                category_name = category.name
-                self.output(
-                    "Category, type '{}', name '{}', already exists on the Jamf Pro server, "
-                    "moving on...".format(category_type, category_name),
-                    verbose_level=2,
-                )
-            except jss.GetError:
-                # Category doesn't exist
-                category = jss.Category(self.jss, category_name)
-                category.save()
-                self.wait_for_id(jss.Category, category)
+            if category_name is not None:
                 try:
-                    category.id
+                    category = self.get_category(category_name)
+                    category_name = category.name
                     self.output(
-                        "Category, type '{}', name '{}', created.".format(
-                            category_type, category_name
-                        )
-                    )
-                    self.env["jss_changed_objects"]["jss_category_added"].append(
-                        category_name
-                    )
-                except ValueError:
-                    raise ProcessorError(
-                        "Failed to get category ID from {}.".format(self.repo_type())
+                        "Category, type '{}', name '{}', already exists on the Jamf Pro server, "
+                        "moving on...".format(category_type, category_name),
+                        verbose_level=2,
                     )
-        else:
-            category = None
-        return category
+                except jss.GetError:
+                    # Category doesn't exist
+                    category = jss.Category(self.jss, category_name)
+                    self.save_object(category)
+                    self.wait_for_id(jss.Category, category_name, category)
+                    try:
+                        category.id
+                        self.add_to_inventory(category)
+                        self.output(
+                            "Category, type '{}', name '{}', created.".format(
+                                category_type, category_name
+                            )
+                        )
+                        self.env["jss_changed_objects"]["jss_category_added"].append(
+                            category_name
+                        )
+                    except ValueError:
+                        raise ProcessorError(
+                            "Failed to get category ID from {}.".format(
+                                self.repo_type()
+                            )
+                        )
+            else:
+                category = None
+            return category
 
     def handle_package(self, stop_if_no_upload):
         """Creates or updates, and copies a package object.
 
         This will only upload a package if a file with the same name
-        does not already exist on a DP. If you need to force a
-        re-upload, you must delete the package on the DP first.
-
-        Further, if you are using a JDS, it will only upload a package
-        if a package object with a filename matching the AutoPkg
-        filename does not exist. If you need to force a re-upload to a
-        JDS, please delete the package object through the web interface
-        first.
+        does not already exist on a DP, or, if you are using a JDS, CDP
+        or AWS, if a package object with a filename matching the AutoPkg
+        filename does not exist.
+
+        With JSS_UPLOAD_ON_HASH_CHANGE set, a package of the same name
+        is also uploaded again if its content has changed, as found by
+        package_content_changed. Otherwise, to force a re-upload, delete
+        the package on the DP, or the package object through the web
+        interface, first.
         """
         # Skip package handling if there is no package or repos.
         pkg_path = self.env["pkg_path"]
@@ -486,7 +1153,7 @@ class JSSImporter(Processor):
 
         # now check if the package object already exists
         try:
-            package = self.jss.Package(self.pkg_name)
+            package = self.get_object(jss.Package, self.pkg_name)
             self.output("Package object already exists on the Jamf Pro server.")
             self.output(
                 "Package ID: {}".format(package.id),
@@ -494,6 +1161,15 @@ class JSSImporter(Processor):
             )
             pkg_update = self.env["jss_changed_objects"]["jss_package_updated"]
             # for cloud DPs we must assume that the package object means there is an associated package
+            # unless its content is known to differ from ours.
+            if (
+                self.repo_type() == "JDS"
+                or self.repo_type() == "CDP"
+                or self.repo_type() == "AWS"
+            ) and self.package_content_changed(package, pkg_path):
+                self.output("Package content has changed. Uploading it again...")
+                self.start_upload(pkg_path, id_=package.id)
+                self.upload_needed = True
         except jss.GetError:
             # Package doesn't exist
             self.output("Package object does not already exist on the Jamf Pro server.")
@@ -506,7 +1182,24 @@ class JSSImporter(Processor):
                 or self.repo_type() == "CDP"
                 or self.repo_type() == "AWS"
             ):
+                if self.pipeline_upload():
+                    # The package object is only created by the upload,
+                    # so the rest of the package handling goes with it.
+                    def upload_package():
+                        """Upload the package, then update its object."""
+                        self.copy(pkg_path)
+                        self.record_package_hash(pkg_path)
+                        package = self.wait_for_id(jss.Package, self.pkg_name)
+                        return self.update_package(
+                            package,
+                            self.env["jss_changed_objects"]["jss_package_added"],
+                        )
+
+                    self.upload_needed = True
+                    self.start_upload_task(upload_package)
+                    return None
                 self.copy(pkg_path)
+                self.record_package_hash(pkg_path)
                 package = self.wait_for_id(jss.Package, self.pkg_name)
                 try:
                     package.id
@@ -542,14 +1235,19 @@ class JSSImporter(Processor):
             or self.repo_type() == "AFP"
             or self.repo_type() == "Local"
         ):
-            if self.jss.distribution_points.exists(os.path.basename(pkg_path)):
+            if self.jss.distribution_points.exists(
+                os.path.basename(pkg_path)
+            ) and not self.package_content_changed(package, pkg_path):
                 self.output("Package upload not required.")
                 self.upload_needed = False
             else:
-                self.copy(pkg_path)
-                self.output(
-                    "Package {} uploaded to distribution point.".format(self.pkg_name)
-                )
+                self.start_upload(pkg_path)
+                if self.upload_future is None:
+                    self.output(
+                        "Package {} uploaded to distribution point.".format(
+                            self.pkg_name
+                        )
+                    )
                 self.upload_needed = True
 
         # only update the package object if an upload ad was carried out
@@ -566,7 +1264,19 @@ class JSSImporter(Processor):
                 "because STOP_IF_NO_JSS_UPLOAD is set to False."
             )
 
-        # now update the package object
+        return self.update_package(package, pkg_update)
+
+    def update_package(self, package, pkg_update):
+        """Update the fields of a package object and save it.
+
+        Args:
+            package: The jss.Package to update.
+            pkg_update: The jss_changed_objects list to add changed
+                fields to.
+
+        Returns:
+            The package.
+        """
         os_requirements = self.env.get("os_requirements")
         package_info = self.env.get("package_info")
         package_notes = self.env.get("package_notes")
@@ -590,17 +1300,439 @@ class JSSImporter(Processor):
                 raise ProcessorError(
                     "Failed to get Package ID from {}.".format(self.repo_type())
                 )
-        self.update_object(cat_name, package, "category", pkg_update)
-        self.update_object(os_requirements, package, "os_requirements", pkg_update)
-        self.update_object(package_info, package, "info", pkg_update)
-        self.update_object(package_notes, package, "notes", pkg_update)
-        self.update_object(package_priority, package, "priority", pkg_update)
-        self.update_object(package_reboot, package, "reboot_required", pkg_update)
+        # Collect all field changes and send them in a single save.
+        fields = (
+            ("category", cat_name),
+            ("os_requirements", os_requirements),
+            ("info", package_info),
+            ("notes", package_notes),
+            ("priority", package_priority),
+            ("reboot_required", package_reboot),
+        )
+        algorithm, _ = self.get_package_record_hash(package)
+        if (
+            algorithm
+            and self.upload_needed
+            and self.repo_type() in ("DP", "SMB", "AFP", "Local")
+        ):
+            # The package record describes the package on the shares,
+            # which has just been replaced.
+            fields += (
+                ("hash_value", self.get_pkg_hash(self.env["pkg_path"], algorithm)),
+            )
+        changed_fields = [
+            path
+            for path, data in fields
+            if self.update_object(data, package, path, pkg_update, save=False)
+        ]
+        if changed_fields or not self.get_object_id(package):
+            self.save_object(package)
+            self.add_to_inventory(package)
+        if changed_fields:
+            self.output("Package fields updated: {}.".format(", ".join(changed_fields)))
+            self.env["jss_changed_objects"]["jss_package_fields_updated"].extend(
+                changed_fields
+            )
         return package
 
+    def pipeline_upload(self):
+        """Return True if package uploads run in the background."""
+        return self.get_bool("JSS_PIPELINE_UPLOAD")
+
+    def start_upload(self, pkg_path, id_=-1):
+        """Copy a package and record its checksum.
+
+        With JSS_PIPELINE_UPLOAD, this happens in the background, and
+        finish_upload must be called to wait for it.
+        """
+
+        def upload_package():
+            """Copy the package and record its checksum."""
+            self.copy(pkg_path, id_=id_)
+            self.record_package_hash(pkg_path)
+
+        if self.pipeline_upload():
+            self.start_upload_task(upload_package)
+        else:
+            upload_package()
+
+    def start_upload_task(self, task):
+        """Run task in the background until finish_upload is called."""
+        self.output("Uploading the package in the background...", verbose_level=2)
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.upload_future = executor.submit(self.in_metrics_context(task))
+        executor.shutdown(wait=False)
+
+    def finish_upload(self):
+        """Wait for a background upload to finish.
+
+        If the upload also created the package object, it becomes
+        self.package. Errors in the upload are raised here.
+        """
+        if self.upload_future is None:
+            return
+        future = self.upload_future
+        self.upload_future = None
+        with self.timed("upload_wait"):
+            package = future.result()
+        if package is not None:
+            self.package = package
+
+    def get_file_hash(self, path, algorithm="sha256"):  # pylint: disable=no-self-use
+        """Return the hex digest of a file, read in bounded-size chunks.
+
+        Args:
+            path (str): Path to the file to hash.
+            algorithm (str): Name of a hashlib algorithm.
+        """
+        digest = hashlib.new(algorithm)
+        with open(path, "rb") as file_handle:
+            for chunk in iter(lambda: file_handle.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def get_bundle_fingerprint(self, path):
+        """Return a digest of the names and contents of a bundle's files.
+
+        Files are hashed in parallel, as hashing releases the GIL.
+
+        Args:
+            path (str): Path to the bundle folder.
+        """
+        members = []
+        for root, _, files in os.walk(path):
+            for member in files:
+                members.append(os.path.join(root, member))
+        members.sort()
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            hashes = list(executor.map(self.get_file_hash, members))
+
+        digest = hashlib.sha256()
+        for member, member_hash in zip(members, hashes):
+            digest.update(os.path.relpath(member, path).encode("utf-8"))
+            digest.update(member_hash.encode("utf-8"))
+        return "{}sha256:{}".format(ZIP_FINGERPRINT_PREFIX, digest.hexdigest())
+
+    def read_json_file(self, path):  # pylint: disable=no-self-use
+        """Return the dict stored in a local JSON state file.
+
+        A missing or unreadable file is treated as empty.
+        """
+        try:
+            with open(path) as file_handle:
+                return json.load(file_handle)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def write_json_file(self, path, data):  # pylint: disable=no-self-use
+        """Atomically replace a local JSON state file with data."""
+        folder = os.path.dirname(path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp_path, "w") as file_handle:
+            json.dump(data, file_handle, indent=2, sort_keys=True)
+        os.rename(temp_path, path)
+
+    def get_pkg_hash(self, pkg_path, algorithm="sha256"):
+        """Return a hash of the package, computing it only once per run."""
+        key = (pkg_path, algorithm)
+        if key not in self.pkg_hashes:
+            self.pkg_hashes[key] = self.get_file_hash(pkg_path, algorithm)
+        return self.pkg_hashes[key]
+
+    def get_package_hash_manifest_path(self):
+        """Return the path to the local manifest of uploaded package hashes."""
+        return os.path.expanduser(
+            self.env.get("JSS_PACKAGE_HASH_MANIFEST")
+            or os.path.join(STATE_DIR, "package_hashes.json")
+        )
+
+    def get_package_record_hash(self, package):  # pylint: disable=no-self-use
+        """Return the hashlib algorithm and checksum on a package record.
+
+        Returns:
+            A tuple of the algorithm and checksum, or of None and None if
+            the record has no checksum of a known type.
+        """
+        algorithm = PACKAGE_HASH_ALGORITHMS.get(package.findtext("hash_type"))
+        hash_value = package.findtext("hash_value")
+        if algorithm and hash_value:
+            return algorithm, hash_value
+        return None, None
+
+    def package_content_changed(self, package, pkg_path):
+        """Return True if pkg_path differs from the package already uploaded.
+
+        Only applies if JSS_UPLOAD_ON_HASH_CHANGE is set. The checksum
+        stored on the Jamf Pro package record is used if there is one,
+        otherwise the checksum recorded in the local manifest when the
+        package was last uploaded. For file share repos, which JSSImporter
+        copies to without the package record being updated, the
+        manifest is used first. If neither is known, the package is
+        assumed to be unchanged, as before.
+
+        Args:
+            package: jss.Package object for the package.
+            pkg_path: Path to the package to be uploaded.
+        """
+        if not self.get_bool("JSS_UPLOAD_ON_HASH_CHANGE"):
+            return False
+
+        with STATE_FILE_LOCK:
+            manifest = self.read_json_file(self.get_package_hash_manifest_path())
+        sources = [
+            ("Jamf Pro package record",) + self.get_package_record_hash(package),
+            (
+                "local package manifest",
+                "sha256",
+                self.get_manifest_hash(manifest, pkg_path),
+            ),
+        ]
+        if self.repo_type() in ("DP", "SMB", "AFP", "Local"):
+            sources.reverse()
+        for source, algorithm, hash_value in sources:
+            if algorithm and hash_value:
+                break
+        else:
+            self.output(
+                "No checksum is known for the uploaded package.", verbose_level=2
+            )
+            return False
+
+        changed = self.get_pkg_hash(pkg_path, algorithm) != hash_value.lower()
+        self.output(
+            "Package checksum {} the {}.".format(
+                "differs from" if changed else "matches", source
+            ),
+            verbose_level=2,
+        )
+        return changed
+
+    def get_manifest_hash(self, manifest, pkg_path):
+        """Return the checksum the manifest has for pkg_path on this server.
+
+        Returns:
+            The checksum recorded for every distribution point, or None
+            if any of them has none, or a different one.
+        """
+        basename = os.path.basename(pkg_path)
+        server = manifest.get(self.env["JSS_URL"], {})
+        hashes = set(
+            server.get(self.get_dp_url(dp), {}).get(basename)
+            for dp in self.jss.distribution_points
+        )
+        return hashes.pop() if len(hashes) == 1 else None
+
+    def record_package_hash(self, pkg_path):
+        """Record the checksum of an uploaded package in the local manifest.
+
+        Checksums are recorded per JSS_URL and distribution point, as
+        another server, or another set of JSS_REPOS, may have an older
+        package of the same name.
+        """
+        if not self.get_bool("JSS_UPLOAD_ON_HASH_CHANGE"):
+            return
+        if self.get_bool("JSS_DRY_RUN"):
+            # Nothing was uploaded.
+            return
+        manifest_path = self.get_package_hash_manifest_path()
+        with STATE_FILE_LOCK:
+            manifest = self.read_json_file(manifest_path)
+            server = manifest.setdefault(self.env["JSS_URL"], {})
+            for dp in self.jss.distribution_points:
+                server.setdefault(self.get_dp_url(dp), {})[
+                    os.path.basename(pkg_path)
+                ] = self.get_pkg_hash(pkg_path)
+            self.write_json_file(manifest_path, manifest)
+
+    def get_recipe_state_key(self):
+        """Return the key of this recipe in the local recipe state file."""
+        return (
+            self.env.get("RECIPE_ID")
+            or self.env.get("RECIPE_PATH")
+            or self.env.get("NAME")
+            or self.prod_name
+        )
+
+    def get_recipe_inputs(self):
+        """Return digests of everything a run would publish.
+
+        Templates are rendered with the values known before connecting
+        to the server, so a change to any value they use changes their
+        digest.
+
+        Returns:
+            A dict of digests, or None if an input could not be read,
+            in which case the recipe must be run in full.
+        """
+
+        def digest(data):
+            """Return the SHA-256 hex digest of text."""
+            if not isinstance(data, bytes):
+                data = data.encode("utf-8")
+            return hashlib.sha256(data).hexdigest()
+
+        self.build_replace_dict()
+        replace_dict = dict(self.replace_dict)
+        replace_dict.setdefault("PKG_NAME", self.pkg_name)
+
+        def render(template_path, replacements=None):
+            """Return the digest of a rendered template."""
+            values = dict(replace_dict)
+            values.update(replacements or {})
+            template, _ = self.render_template(
+                self.load_template(self.find_file_in_search_path(template_path)),
+                values,
+            )
+            return digest(template)
+
+        settings = {
+            key: self.env.get(key)
+            for key in self.input_variables
+            if key not in ("API_PASSWORD", "JSS_STATE_VERIFY_INTERVAL")
+        }
+        inputs = {
+            "settings": digest(json.dumps(settings, sort_keys=True, default=str)),
+            "version": self.version,
+            "templates": {},
+        }
+        try:
+            pkg_path = self.env.get("pkg_path")
+            if pkg_path:
+                if os.path.isdir(pkg_path):
+                    inputs["package"] = self.get_bundle_fingerprint(pkg_path)
+                else:
+                    inputs["package"] = self.get_pkg_hash(pkg_path)
+            templates = inputs["templates"]
+            if self.env.get("policy_template"):
+                templates["policy"] = render(self.env["policy_template"])
+            for group in (self.env.get("groups") or []) + (
+                self.env.get("exclusion_groups") or []
+            ):
+                if group.get("smart", False) and group.get("template_path"):
+                    templates["group " + group["name"]] = render(
+                        group["template_path"], self.get_group_replacements(group)
+                    )
+            for extattr in self.env.get("extension_attributes") or []:
+                path = extattr["ext_attribute_path"]
+                templates["extension attribute " + path] = render(path)
+            for script in self.env.get("scripts") or []:
+                with open(self.find_file_in_search_path(script["name"])) as handle:
+                    contents = handle.read()
+                templates["script " + script["name"]] = digest(
+                    render(script["template_path"]) + digest(contents)
+                )
+            if self.env.get("self_service_icon"):
+                inputs["icon"] = self.get_file_hash(
+                    self.find_file_in_search_path(self.env["self_service_icon"])
+                )
+        except (ProcessorError, IOError, OSError, KeyError) as error:
+            self.output(
+                "Could not compare this run with the last: {}".format(error),
+                verbose_level=2,
+            )
+            return None
+        return inputs
+
+    def recipe_state_unchanged(self, inputs):
+        """Return True if inputs match the last run that was published.
+
+        A recipe is run in full if JSS_STATE_VERIFY_INTERVAL seconds
+        have passed since it last was, even if nothing has changed.
+        """
+        if inputs is None:
+            return False
+        with STATE_FILE_LOCK:
+            states = self.read_json_file(os.path.join(STATE_DIR, "recipe_state.json"))
+        state = states.get(self.get_recipe_state_key())
+        if not state or state.get("inputs") != inputs:
+            return False
+        interval = self.get_number("JSS_STATE_VERIFY_INTERVAL")
+        if interval and time.time() - state.get("verified", 0) >= interval:
+            self.output(
+                "Inputs are unchanged, but verifying the server state.",
+                verbose_level=2,
+            )
+            return False
+        return True
+
+    def record_recipe_state(self, inputs):
+        """Record a successful run's inputs and the IDs it published."""
+
+        def ids(objects):
+            """Return a dict of object names and IDs."""
+            return {
+                obj.name: self.get_object_id(obj)
+                for obj in objects or []
+                if obj is not None
+            }
+
+        state = {
+            "inputs": inputs,
+            "verified": time.time(),
+            "ids": {
+                "categories": ids([self.category, self.policy_category]),
+                "package": ids([self.package]),
+                "extension_attributes": ids(self.extattrs),
+                "groups": ids((self.groups or []) + (self.exclusion_groups or [])),
+                "scripts": ids(self.scripts),
+                "policy": ids([self.policy]),
+            },
+        }
+        path = os.path.join(STATE_DIR, "recipe_state.json")
+        with STATE_FILE_LOCK:
+            states = self.read_json_file(path)
+            states[self.get_recipe_state_key()] = state
+            self.write_json_file(path, states)
+
+    def refresh_recipe_state(self, inputs):
+        """Record that a run which stopped early found nothing to change.
+
+        Only the time the state was verified is updated, and only if the
+        inputs are those already recorded, as a run which stops early
+        does not publish the objects.
+        """
+        path = os.path.join(STATE_DIR, "recipe_state.json")
+        with STATE_FILE_LOCK:
+            states = self.read_json_file(path)
+            state = states.get(self.get_recipe_state_key())
+            if state and state.get("inputs") == inputs:
+                state["verified"] = time.time()
+                self.write_json_file(path, states)
+
+    def get_zip_compression(self):
+        """Return the ZipFile arguments for JSS_ZIP_COMPRESSION.
+
+        Raises:
+            ProcessorError if JSS_ZIP_COMPRESSION isn't 'store' or a level
+            from 0 to 9.
+        """
+        compression = "{}".format(self.env.get("JSS_ZIP_COMPRESSION") or "").strip()
+        if not compression:
+            return {"compression": ZIP_DEFLATED}
+        if compression.lower() == "store":
+            return {"compression": ZIP_STORED}
+        try:
+            level = int(compression)
+        except ValueError:
+            level = None
+        if level is None or not 0 <= level <= 9:
+            raise ProcessorError(
+                "JSS_ZIP_COMPRESSION must be 'store' or a level from 0 to 9, "
+                "not '{}'.".format(compression)
+            )
+        return {"compression": ZIP_DEFLATED, "compresslevel": level}
+
     def zip_pkg_path(self, path):
         """Add files from path to a zip file handle.
 
+        Files are compressed by up to JSS_ZIP_WORKERS threads, and
+        written to the zip in order by this one. If JSS_ZIP_REUSE is
+        set, the zip's comment records a fingerprint of the bundle's
+        contents and the compression settings, and a zip with a matching
+        fingerprint that already exists is used as it is.
+
         Args:
             path (str): Path to folder to zip.
 
@@ -608,84 +1740,329 @@ class JSSImporter(Processor):
             (str) name of resulting zip file.
         """
         zip_name = "{}.zip".format(path)
+        zip_kwargs = self.get_zip_compression()
+
+        fingerprint = None
+        if self.get_bool("JSS_ZIP_REUSE"):
+            # Fingerprinting reads the whole bundle, so it is only worth
+            # doing if the zip may be reused.
+            fingerprint = "{} compression:{}".format(
+                self.get_bundle_fingerprint(path),
+                (
+                    "store"
+                    if zip_kwargs["compression"] == ZIP_STORED
+                    else zip_kwargs.get("compresslevel", "default")
+                ),
+            )
+            if os.path.isfile(zip_name):
+                try:
+                    with ZipFile(zip_name) as zip_handle:
+                        existing_fingerprint = zip_handle.comment.decode("utf-8")
+                except (BadZipfile, IOError, UnicodeDecodeError):
+                    existing_fingerprint = None
+                if existing_fingerprint == fingerprint:
+                    self.output("Bundle unchanged, reusing: {}".format(zip_name))
+                    return zip_name
+
+        start = time.time()
+        size = 0
+        members = [
+            os.path.join(root, member)
+            for root, _, files in os.walk(path)
+            for member in files
+        ]
+        workers = int(self.get_number("JSS_ZIP_WORKERS")) or os.cpu_count() or 1
+        with ZipFile(zip_name, "w", allowZip64=True, **zip_kwargs) as zip_handle:
+            if workers > 1 and zip_kwargs["compression"] == ZIP_DEFLATED:
+                level = zip_kwargs.get("compresslevel", zlib.Z_DEFAULT_COMPRESSION)
+                pending = deque()
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    try:
+                        for member in members:
+                            pending.append(
+                                executor.submit(self.compress_zip_member, member, level)
+                            )
+                            # Only a few members wait in temporary files.
+                            if len(pending) >= workers * 2:
+                                size += self.write_zip_member(
+                                    zip_handle, *pending.popleft().result()
+                                )
+                        while pending:
+                            size += self.write_zip_member(
+                                zip_handle, *pending.popleft().result()
+                            )
+                    finally:
+                        for future in pending:
+                            if not future.cancel() and future.exception() is None:
+                                future.result()[1].close()
+            else:
+                for member in members:
+                    # ZipFile.write streams each member in chunks.
+                    zip_handle.write(member)
+                    size += os.path.getsize(member)
 
-        with ZipFile(zip_name, "w", ZIP_DEFLATED, allowZip64=True) as zip_handle:
-
-            for root, _, files in os.walk(path):
-                for member in files:
-                    zip_handle.write(os.path.join(root, member))
-
+            if fingerprint:
+                zip_handle.comment = fingerprint.encode("utf-8")
             self.output("Closing: {}".format(zip_name))
 
+        elapsed = max(time.time() - start, 0.001)
+        self.output(
+            "Zipped {:.1f} MB in {:.1f} seconds ({:.1f} MB/s)".format(
+                size / 1e6, elapsed, size / 1e6 / elapsed
+            ),
+            verbose_level=2,
+        )
+
         return zip_name
 
+    def compress_zip_member(self, path, level):  # pylint: disable=no-self-use
+        """Deflate a file into a temporary file, for write_zip_member.
+
+        zlib releases the GIL while it compresses, so files can be
+        compressed in several threads at once.
+
+        Returns:
+            A tuple of the file's ZipInfo, with its checksum and sizes,
+            and a temporary file holding its raw deflate stream.
+        """
+        zinfo = ZipInfo.from_file(path)
+        zinfo.compress_type = ZIP_DEFLATED
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        compressed = tempfile.TemporaryFile()
+        crc = size = 0
+        try:
+            with open(path, "rb") as source:
+                for chunk in iter(lambda: source.read(HASH_CHUNK_SIZE), b""):
+                    crc = zlib.crc32(chunk, crc)
+                    size += len(chunk)
+                    compressed.write(compressor.compress(chunk))
+            compressed.write(compressor.flush())
+        except Exception:
+            compressed.close()
+            raise
+        zinfo.CRC = crc
+        zinfo.file_size = size
+        zinfo.compress_size = compressed.tell()
+        compressed.seek(0)
+        return zinfo, compressed
+
+    def write_zip_member(
+        self, zip_handle, zinfo, compressed
+    ):  # pylint: disable=no-self-use
+        """Append a member compressed by compress_zip_member to a zip.
+
+        The member is written as ZipFile.write would, and recorded in
+        the ZipFile's list of members for its central directory.
+
+        Returns:
+            The uncompressed size of the member.
+        """
+        with compressed:
+            zinfo.header_offset = zip_handle.fp.tell()
+            zip_handle.fp.write(zinfo.FileHeader())
+            shutil.copyfileobj(compressed, zip_handle.fp, HASH_CHUNK_SIZE)
+        zip_handle.filelist.append(zinfo)
+        zip_handle.NameToInfo[zinfo.filename] = zinfo
+        zip_handle.start_dir = zip_handle.fp.tell()
+        return zinfo.file_size
+
     def handle_extension_attributes(self):
         """Add extension attributes if needed."""
         extattrs = self.env.get("extension_attributes")
         results = []
         if extattrs:
             for extattr in extattrs:
-                extattr_object = self.update_or_create_new(
-                    jss.ComputerExtensionAttribute,
-                    extattr["ext_attribute_path"],
-                    update_env="jss_extension_attribute_added",
-                    added_env="jss_extension_attribute_updated",
-                )
-
-                results.append(extattr_object)
+                results.append(self.handle_extension_attribute(extattr))
         return results
 
+    def handle_extension_attribute(self, extattr):
+        """Create or update a single extension attribute."""
+        return self.update_or_create_new(
+            jss.ComputerExtensionAttribute,
+            extattr["ext_attribute_path"],
+            update_env="jss_extension_attribute_added",
+            added_env="jss_extension_attribute_updated",
+        )
+
     def handle_groups(self, groups):
         """Manage group existence and creation."""
         computer_groups = []
         if groups:
             for group in groups:
-                self.output(
-                    "Computer Group to process: {}".format(group["name"]),
-                    verbose_level=3,
-                )
-                if self.validate_input_var(group):
-                    is_smart = group.get("smart", False)
-                    if is_smart:
-                        computer_group = self.add_or_update_smart_group(group)
-                    else:
-                        computer_group = self.add_or_update_static_group(group)
-
+                computer_group = self.handle_group(group)
+                if computer_group is not None:
+                    if group.get("smart", False):
+                        self.replace_dict.update(self.get_group_replacements(group))
                     computer_groups.append(computer_group)
 
         return computer_groups
 
+    def handle_group(self, group):
+        """Create or update a single group.
+
+        Returns:
+            The computer group, or None if the group is not valid.
+        """
+        self.output(
+            "Computer Group to process: {}".format(group["name"]),
+            verbose_level=3,
+        )
+        if not self.validate_input_var(group):
+            return None
+        is_smart = group.get("smart", False)
+        if is_smart:
+            return self.add_or_update_smart_group(group)
+        return self.add_or_update_static_group(group)
+
     def handle_scripts(self):
         """Add scripts if needed."""
         scripts = self.env.get("scripts")
         results = []
         if scripts:
             for script in scripts:
-                self.output(
-                    "Looking for Script file {}...".format(script["name"]),
-                    verbose_level=2,
-                )
-                script_file = self.find_file_in_search_path(script["name"])
-                try:
-                    with open(script_file) as script_handle:
-                        script_contents = script_handle.read()
-                except IOError:
-                    raise ProcessorError(
-                        "Script '{}' could not be read!".format(script_file)
-                    )
+                results.append(self.handle_script(script))
+
+        return results
+
+    def handle_script(self, script):
+        """Create or update a single script."""
+        self.output(
+            "Looking for Script file {}...".format(script["name"]),
+            verbose_level=2,
+        )
+        script_file = self.find_file_in_search_path(script["name"])
+        try:
+            with open(script_file) as script_handle:
+                script_contents = script_handle.read()
+        except IOError:
+            raise ProcessorError("Script '{}' could not be read!".format(script_file))
+
+        return self.update_or_create_new(
+            jss.Script,
+            script["template_path"],
+            os.path.basename(script_file),
+            added_env="jss_script_added",
+            update_env="jss_script_updated",
+            script_contents=script_contents,
+        )
+
+    def handle_policy_objects(self):
+        """Create or update the objects that a policy is assembled from.
+
+        Extension attributes, groups, exclusion groups and scripts are
+        processed by up to JSS_OBJECT_CONCURRENCY workers, waited on as
+        set by JSS_EXECUTION_BACKEND. Groups may have criteria that
+        refer to extension attributes, so they are only started once
+        all extension attributes are done. Results are kept in the
+        order given in the recipe.
+        """
+        max_workers = int(self.get_number("JSS_OBJECT_CONCURRENCY"))
+        if max_workers <= 1:
+            self.extattrs = self.handle_extension_attributes()
+            self.groups = self.handle_groups(self.env.get("groups"))
+            self.exclusion_groups = self.handle_groups(self.env.get("exclusion_groups"))
+            self.scripts = self.handle_scripts()
+            return
 
-                script_object = self.update_or_create_new(
-                    jss.Script,
-                    script["template_path"],
-                    os.path.basename(script_file),
-                    added_env="jss_script_added",
-                    update_env="jss_script_updated",
-                    script_contents=script_contents,
+        groups = self.env.get("groups") or []
+        exclusion_groups = self.env.get("exclusion_groups") or []
+        if self.env.get("JSS_EXECUTION_BACKEND") == "asyncio":
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(
+                    self.handle_policy_objects_async(
+                        max_workers, groups, exclusion_groups
+                    )
                 )
+            finally:
+                loop.close()
+        else:
+            handle_extension_attribute = self.in_metrics_context(
+                self.handle_extension_attribute
+            )
+            handle_group = self.in_metrics_context(self.handle_group)
+            handle_script = self.in_metrics_context(self.handle_script)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                extattr_futures = [
+                    executor.submit(handle_extension_attribute, extattr)
+                    for extattr in self.env.get("extension_attributes") or []
+                ]
+                script_futures = [
+                    executor.submit(handle_script, script)
+                    for script in self.env.get("scripts") or []
+                ]
+                self.extattrs = [future.result() for future in extattr_futures]
+
+                group_futures = [
+                    executor.submit(handle_group, group) for group in groups
+                ]
+                exclusion_group_futures = [
+                    executor.submit(handle_group, group) for group in exclusion_groups
+                ]
+                self.groups = [future.result() for future in group_futures]
+                self.exclusion_groups = [
+                    future.result() for future in exclusion_group_futures
+                ]
+                self.scripts = [future.result() for future in script_futures]
+
+        # Drop invalid groups, and leave the replacement values of the
+        # last smart group in place, as handle_groups does.
+        for group, computer_group in zip(
+            groups + exclusion_groups, self.groups + self.exclusion_groups
+        ):
+            if computer_group is not None and group.get("smart", False):
+                self.replace_dict.update(self.get_group_replacements(group))
+        self.groups = [group for group in self.groups if group is not None]
+        self.exclusion_groups = [
+            group for group in self.exclusion_groups if group is not None
+        ]
 
-                results.append(script_object)
+    async def handle_policy_objects_async(self, max_workers, groups, exclusion_groups):
+        """Process policy objects as coroutines, for handle_policy_objects.
 
-        return results
+        Each object is a task which holds a semaphore of max_workers
+        while its blocking python-jss calls run in a thread pool of the
+        same size, so tasks wait on the event loop rather than in the
+        pool's queue. The requests made are the same as with threads.
+        """
+        loop = asyncio.get_event_loop()
+        semaphore = asyncio.Semaphore(max_workers)
+        tasks = []
+
+        async def process(function, item):
+            """Call function(item) in the pool once the semaphore allows."""
+            async with semaphore:
+                return await loop.run_in_executor(executor, function, item)
+
+        def start(function, items):
+            """Start a task per item, and return the tasks in order."""
+            function = self.in_metrics_context(function)
+            started = [asyncio.ensure_future(process(function, item)) for item in items]
+            tasks.extend(started)
+            return started
+
+        async def results(started):
+            """Return the results of tasks in order."""
+            return [await task for task in started]
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            try:
+                extattr_tasks = start(
+                    self.handle_extension_attribute,
+                    self.env.get("extension_attributes") or [],
+                )
+                script_tasks = start(self.handle_script, self.env.get("scripts") or [])
+                self.extattrs = await results(extattr_tasks)
+
+                group_tasks = start(self.handle_group, groups)
+                exclusion_group_tasks = start(self.handle_group, exclusion_groups)
+                self.groups = await results(group_tasks)
+                self.exclusion_groups = await results(exclusion_group_tasks)
+                self.scripts = await results(script_tasks)
+            finally:
+                # Let tasks still running when another failed finish, so
+                # the loop can be closed cleanly.
+                await asyncio.gather(*tasks, return_exceptions=True)
 
     def handle_policy(self):
         """Create or update a policy."""
@@ -719,77 +2096,649 @@ class JSSImporter(Processor):
         # we first check for an existing policy, and if it exists, copy
         # its icon XML, which is then added to the templated Policy. If
         # there is no icon information, but the recipe specifies one,
-        # then FileUpload it up.
+        # then FileUpload it up. With JSS_ICON_REGISTRY, the IDs of
+        # icons we have uploaded are remembered by checksum, so an icon
+        # already on the server is reused rather than uploaded again.
 
         # If no policy handling is desired, we can't upload an icon.
         if self.env.get("self_service_icon") and self.policy is not None:
             # Search through search-paths for icon file.
             self.output(
-                "Looking for Icon file {}...".format(self.env["self_service_icon"]),
+                "Looking for Icon file {}...".format(self.env["self_service_icon"]),
+                verbose_level=2,
+            )
+            icon_path = self.find_file_in_search_path(self.env["self_service_icon"])
+            icon_filename = os.path.basename(icon_path)
+
+            # Compare the filename in the policy to the one provided by
+            # the recipe. If they don't match, we need to upload a new
+            # icon. With the icon registry, a reused icon keeps the
+            # name it was uploaded with, so the icon's ID is compared
+            # instead.
+            policy_filename = self.policy.findtext(
+                "self_service/self_service_icon/filename"
+            )
+            policy_icon_id = self.policy.findtext("self_service/self_service_icon/id")
+            icon_hash = None
+            matches = policy_filename == icon_filename
+            if self.get_bool("JSS_ICON_REGISTRY"):
+                icon_hash = self.get_file_hash(icon_path)
+                known = self.get_known_icon(icon_hash)
+                # Only icons JSSImporter uploaded are known, as an icon
+                # of the same name may have different content.
+                if known:
+                    matches = policy_icon_id == str(known["id"])
+
+            if not matches:
+                self.output(
+                    "Icon name in existing policy: {}".format(policy_filename),
+                    verbose_level=2,
+                )
+                with ICON_LOCK:
+                    if icon_hash is not None and self.reuse_icon(icon_hash):
+                        return
+                    upload_path = icon_path
+                    if self.get_bool("JSS_OPTIMIZE_ICONS"):
+                        upload_path = self.optimize_icon(icon_path)
+                    if self.get_bool("JSS_DRY_RUN"):
+                        self.plan_upload("Icon", upload_path)
+                    else:
+                        icon = jss.FileUpload(
+                            self.jss, "policies", "id", self.policy.id, upload_path
+                        )
+                        icon.save()
+                        if icon_hash is not None:
+                            policy = self.jss.Policy(self.get_object_id(self.policy))
+                            self.record_icon(
+                                icon_hash,
+                                policy.findtext("self_service/self_service_icon/id"),
+                                icon_filename,
+                            )
+                self.env["jss_changed_objects"]["jss_icon_uploaded"].append(
+                    icon_filename
+                )
+                self.output("Icon uploaded to the Jamf Pro server.")
+            else:
+                self.output("Icon matches existing icon, moving on...")
+
+    def optimize_icon(self, icon_path):
+        """Return the path to a smaller copy of a PNG icon.
+
+        Icons larger than JSS_ICON_MAX_SIZE are downscaled with Pillow,
+        or sips if Pillow is not installed, and the image data is
+        recompressed at the highest level. The result keeps the icon's
+        filename, so policies still match it by name, and is cached in
+        the JSSImporter state folder by the checksum of the original.
+        If it would not be smaller, the original is used.
+        """
+        with open(icon_path, "rb") as icon_file:
+            data = icon_file.read()
+        if not data.startswith(PNG_SIGNATURE):
+            return icon_path
+        max_size = int(self.get_number("JSS_ICON_MAX_SIZE"))
+        cache_folder = os.path.join(
+            STATE_DIR,
+            "icons",
+            "{}-{}".format(hashlib.sha256(data).hexdigest(), max_size),
+        )
+        cached_path = os.path.join(cache_folder, os.path.basename(icon_path))
+        if os.path.exists(cached_path):
+            return cached_path
+        if not os.path.isdir(cache_folder):
+            os.makedirs(cache_folder)
+
+        temp_path = "{}.{}.tmp".format(cached_path, os.getpid())
+        width, height = struct.unpack(">II", data[16:24])
+        if max_size and max(width, height) > max_size:
+            try:
+                # Pillow is only imported for the icons which need it.
+                from PIL import Image  # pylint: disable=import-outside-toplevel
+            except ImportError:
+                Image = None  # pylint: disable=invalid-name
+            if Image is not None:
+                image = Image.open(icon_path)
+                image.thumbnail((max_size, max_size), Image.LANCZOS)
+                image.save(temp_path, "PNG", optimize=True)
+            elif os.path.exists("/usr/bin/sips"):
+                with open(os.devnull, "w") as devnull:
+                    subprocess.check_call(
+                        [
+                            "/usr/bin/sips",
+                            "--resampleHeightWidthMax",
+                            str(max_size),
+                            icon_path,
+                            "--out",
+                            temp_path,
+                        ],
+                        stdout=devnull,
+                    )
+            if os.path.exists(temp_path):
+                with open(temp_path, "rb") as icon_file:
+                    data = icon_file.read()
+
+        data = self.recompress_png(data)
+        with open(temp_path, "wb") as icon_file:
+            icon_file.write(data)
+        os.rename(temp_path, cached_path)
+
+        if os.path.getsize(cached_path) >= os.path.getsize(icon_path):
+            # Keep the original, but remember that it can't be improved.
+            with open(icon_path, "rb") as icon_file:
+                data = icon_file.read()
+            with open(cached_path, "wb") as icon_file:
+                icon_file.write(data)
+        self.output(
+            "Optimized icon from {} to {} bytes.".format(
+                os.path.getsize(icon_path), os.path.getsize(cached_path)
+            ),
+            verbose_level=2,
+        )
+        return cached_path
+
+    def recompress_png(self, data):  # pylint: disable=no-self-use
+        """Return PNG data with its image data deflated at level 9.
+
+        The IDAT chunks are merged into one, and every other chunk is
+        kept as is, so the image is unchanged. The original data is
+        returned if it is not a valid PNG or would not get smaller.
+        """
+        chunks = []
+        image_data = []
+        position = len(PNG_SIGNATURE)
+        try:
+            while position < len(data):
+                (length,) = struct.unpack(">I", data[position : position + 4])
+                chunk_type = data[position + 4 : position + 8]
+                body = data[position + 8 : position + 8 + length]
+                position += length + 12
+                if chunk_type == b"IDAT":
+                    if not image_data:
+                        chunks.append((chunk_type, None))
+                    image_data.append(body)
+                else:
+                    chunks.append((chunk_type, body))
+            compressed = zlib.compress(zlib.decompress(b"".join(image_data)), 9)
+        except (struct.error, zlib.error):
+            return data
+
+        result = [PNG_SIGNATURE]
+        for chunk_type, body in chunks:
+            if body is None:
+                body = compressed
+            result.append(struct.pack(">I", len(body)) + chunk_type + body)
+            result.append(struct.pack(">I", zlib.crc32(chunk_type + body) & 0xFFFFFFFF))
+        result = b"".join(result)
+        return result if len(result) < len(data) else data
+
+    def get_icon_registry_path(self):  # pylint: disable=no-self-use
+        """Return the path to the local registry of uploaded icons."""
+        return os.path.join(STATE_DIR, "icon_registry.json")
+
+    def record_icon(self, icon_hash, icon_id, filename):
+        """Record the server ID of the icon with checksum icon_hash.
+
+        Icon IDs differ between servers, so the registry is kept per
+        JSS_URL. Only icons JSSImporter has uploaded are recorded.
+        """
+        try:
+            icon_id = int(icon_id)
+        except (TypeError, ValueError):
+            return
+        if not icon_id or self.get_bool("JSS_DRY_RUN"):
+            return
+        path = self.get_icon_registry_path()
+        with STATE_FILE_LOCK:
+            registry = self.read_json_file(path)
+            icons = registry.setdefault(self.env["JSS_URL"], {})
+            icons[icon_hash] = {"id": icon_id, "filename": filename}
+            self.write_json_file(path, registry)
+
+    def get_known_icon(self, icon_hash):
+        """Return the registry entry of the icon with checksum icon_hash.
+
+        Returns:
+            A dict with the icon's "id" and "filename" on this server,
+            or None if it has not been recorded.
+        """
+        with STATE_FILE_LOCK:
+            registry = self.read_json_file(self.get_icon_registry_path())
+        return registry.get(self.env["JSS_URL"], {}).get(icon_hash)
+
+    def reuse_icon(self, icon_hash):
+        """Set the policy's icon to a known icon with checksum icon_hash.
+
+        Returns:
+            True if the policy now uses an icon already on the server,
+            False if the icon must be uploaded.
+        """
+        known = self.get_known_icon(icon_hash)
+        if not known:
+            return False
+
+        icon_xml = self.ensure_xml_structure(
+            self.policy, "self_service/self_service_icon/id"
+        )
+        icon_xml.text = str(known["id"])
+        self.save_object(self.policy)
+        if not self.get_bool("JSS_DRY_RUN"):
+            # The server ignores IDs of icons which no longer exist.
+            policy = self.jss.Policy(self.get_object_id(self.policy))
+            if policy.findtext("self_service/self_service_icon/id") != str(known["id"]):
+                self.output(
+                    "Icon {} is no longer on the server.".format(known["id"]),
+                    verbose_level=2,
+                )
+                return False
+        self.output(
+            "Reusing icon {} ({}) already on the Jamf Pro server.".format(
+                known["id"], known["filename"]
+            )
+        )
+        return True
+
+    def update_object(self, data, obj, path, update, save=True):
+        """Update an object if it differs.
+
+        If a value differs between the recipe and the object, update
+        the object to reflect the change, and add the object to a
+        summary list.
+
+        Args:
+            data: Recipe string value to enforce.
+            obj: JSSObject type to set data on.
+            path: String path to desired XML.
+            update: Summary list object to append obj to if something
+                is changed.
+            save: If False, only change the XML and leave it to the
+                caller to save the object, so that several changes can
+                be sent in a single request.
+
+        Returns:
+            True if the value was changed, otherwise False.
+        """
+        if data != obj.findtext(path):
+            obj.find(path).text = data
+            if save:
+                self.save_object(obj)
+                self.output(
+                    "{} '{}' updated.".format(
+                        str(obj.__class__).split(".")[-1][:-2], path
+                    )
+                )
+            update.append(obj.name)
+            return True
+        return False
+
+    def copy(self, source_item, id_=-1):
+        """Copy a package or script using the JSS_REPOS preference."""
+        if self.get_bool("JSS_DRY_RUN"):
+            self.plan_upload(
+                "Package",
+                source_item,
+                destinations=max(1, len(self.jss.distribution_points)),
+            )
+            self.env["jss_changed_objects"]["jss_repo_updated"].append(
+                os.path.basename(source_item)
+            )
+            return
+
+        self.output("Copying {} to all distribution points.".format(source_item))
+
+        def output_copy_status(connection):
+            """Output AutoPkg copying status."""
+            self.output("Copying to {}".format(connection["url"]))
+
+        max_workers = int(self.get_number("JSS_COPY_CONCURRENCY"))
+        with self.timed("upload"):
+            if (
+                (max_workers > 1 and len(self.jss.distribution_points) > 1)
+                or self.get_number("JSS_UPLOAD_RETRIES") > 0
+                or self.get_bool("JSS_UPLOAD_CHECKPOINT")
+                or self.get_bool("JSS_STREAMING_COPY")
+                or self.get_number("JSS_UPLOAD_CHUNK_SIZE") > 0
+            ):
+                self.copy_to_each_dp(
+                    source_item, id_, max_workers, pre_callback=output_copy_status
+                )
+            else:
+                self.jss.distribution_points.copy(
+                    source_item, id_=id_, pre_callback=output_copy_status
+                )
+        self.env["jss_changed_objects"]["jss_repo_updated"].append(
+            os.path.basename(source_item)
+        )
+        self.output("Copied '{}'".format(source_item))
+
+    def get_upload_checkpoint_key(self, source_item):  # pylint: disable=no-self-use
+        """Return the key identifying this version of a file in the checkpoint."""
+        stat = os.stat(source_item)
+        return "{}:{}:{}".format(
+            os.path.basename(source_item), stat.st_size, int(stat.st_mtime)
+        )
+
+    def copy_to_each_dp(self, source_item, id_, max_workers, pre_callback=None):
+        """Copy to each distribution point with a bounded pool of workers.
+
+        Every distribution point is attempted, even if copying to
+        another one fails. Failed copies are retried up to
+        JSS_UPLOAD_RETRIES times, and failures are reported together
+        afterwards.
+
+        With JSS_STREAMING_COPY, packages are copied to mounted file
+        shares by stream_copy rather than by python-jss, and with
+        JSS_UPLOAD_CHUNK_SIZE, to AWS distribution points by
+        multipart_upload.
+
+        If JSS_UPLOAD_CHECKPOINT is set, each completed copy is recorded
+        in a local checkpoint file, so that a run which was interrupted
+        resumes by copying only to the distribution points which did not
+        receive this version of the file.
+
+        Args:
+            source_item: Path to the file to copy.
+            id_: ID of the package or script object, as for
+                python-jss' DistributionPoints.copy.
+            max_workers: Maximum number of copies to run at once.
+            pre_callback: Function called with each distribution
+                point's connection dict before copying to it.
+        """
+        use_checkpoint = self.get_bool("JSS_UPLOAD_CHECKPOINT")
+        checkpoint_path = os.path.join(STATE_DIR, "upload_checkpoint.json")
+        checkpoint_key = self.get_upload_checkpoint_key(source_item)
+        if use_checkpoint:
+            with STATE_FILE_LOCK:
+                completed = self.read_json_file(checkpoint_path).get(checkpoint_key, [])
+        else:
+            completed = []
+        retries = int(self.get_number("JSS_UPLOAD_RETRIES"))
+
+        def record_checkpoint(url):
+            """Record a completed copy in the checkpoint file."""
+            with STATE_FILE_LOCK:
+                checkpoint = self.read_json_file(checkpoint_path)
+                checkpoint.setdefault(checkpoint_key, []).append(url)
+                self.write_json_file(checkpoint_path, checkpoint)
+
+        def copy_to_dp(dp):
+            """Copy source_item to a single distribution point."""
+            url = self.get_dp_url(dp)
+            if url in completed:
+                self.output(
+                    "Skipping {}, which already received this file.".format(url)
+                )
+                return
+            delays = self.wait_delays()
+            for attempt in range(retries + 1):
+                if pre_callback:
+                    pre_callback(dp.connection)
+                start = time.time()
+                try:
+                    destination = self.get_streaming_destination(dp, source_item)
+                    if destination:
+                        self.stream_copy(source_item, destination)
+                    elif self.use_multipart_upload(dp, source_item):
+                        self.multipart_upload(dp, source_item, id_)
+                    else:
+                        dp.copy_pkg(source_item, id_)
+                    break
+                except Exception as error:  # pylint: disable=broad-except
+                    if attempt == retries:
+                        raise
+                    delay = next(delays)
+                    self.output(
+                        "Copying to {} failed: {}. Retrying in {:.1f} "
+                        "seconds...".format(url, error, delay)
+                    )
+                    time.sleep(delay)
+            self.output(
+                "Copied to {} in {:.1f} seconds".format(url, time.time() - start),
                 verbose_level=2,
             )
-            icon_path = self.find_file_in_search_path(self.env["self_service_icon"])
-            icon_filename = os.path.basename(icon_path)
-
-            # Compare the filename in the policy to the one provided by
-            # the recipe. If they don't match, we need to upload a new
-            # icon.
-            policy_filename = self.policy.findtext(
-                "self_service/self_service_icon/filename"
+            if use_checkpoint:
+                record_checkpoint(url)
+
+        dps = list(self.jss.distribution_points)
+        errors = []
+
+        def record_error(dp, error):
+            """Report a distribution point that could not be copied to."""
+            self.output("Copying to {} failed: {}".format(self.get_dp_url(dp), error))
+            errors.append(self.get_dp_url(dp))
+
+        if max_workers > 1:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(dps))) as executor:
+                futures = [
+                    (dp, executor.submit(self.in_metrics_context(copy_to_dp), dp))
+                    for dp in dps
+                ]
+                for dp, future in futures:
+                    try:
+                        future.result()
+                    except Exception as error:  # pylint: disable=broad-except
+                        record_error(dp, error)
+        else:
+            for dp in dps:
+                try:
+                    copy_to_dp(dp)
+                except Exception as error:  # pylint: disable=broad-except
+                    record_error(dp, error)
+        if errors:
+            raise ProcessorError(
+                "Failed to copy {} to: {}".format(source_item, ", ".join(errors))
             )
-            if not policy_filename == icon_filename:
-                self.output(
-                    "Icon name in existing policy: {}".format(policy_filename),
-                    verbose_level=2,
-                )
-                icon = jss.FileUpload(
-                    self.jss, "policies", "id", self.policy.id, icon_path
-                )
-                icon.save()
-                self.env["jss_changed_objects"]["jss_icon_uploaded"].append(
-                    icon_filename
+
+        # Every distribution point has the file now, so a later upload
+        # of the same file must not be skipped.
+        if use_checkpoint:
+            with STATE_FILE_LOCK:
+                checkpoint = self.read_json_file(checkpoint_path)
+                if checkpoint.pop(checkpoint_key, None) is not None:
+                    self.write_json_file(checkpoint_path, checkpoint)
+
+    def get_dp_url(self, dp):  # pylint: disable=no-self-use
+        """Return the URL of a distribution point as text.
+
+        AWS distribution points have their bucket as their URL.
+        """
+        return "{}".format(dp.connection.get("url"))
+
+    def use_multipart_upload(self, dp, source_item):
+        """Return True if source_item is uploaded to dp by multipart_upload.
+
+        Raises:
+            ProcessorError if JSS_UPLOAD_CHUNK_SIZE is too small for S3.
+        """
+        chunk_size = int(self.get_number("JSS_UPLOAD_CHUNK_SIZE"))
+        if 0 < chunk_size < MIN_UPLOAD_CHUNK_SIZE:
+            raise ProcessorError(
+                "JSS_UPLOAD_CHUNK_SIZE must be 0 or at least {}.".format(
+                    MIN_UPLOAD_CHUNK_SIZE
                 )
-                self.output("Icon uploaded to the Jamf Pro server.")
-            else:
-                self.output("Icon matches existing icon, moving on...")
+            )
+        return (
+            chunk_size > 0
+            and isinstance(dp, jss.distribution_point.AWS)
+            and os.path.isfile(source_item)
+        )
 
-    def update_object(self, data, obj, path, update):
-        """Update an object if it differs.
+    def multipart_upload(self, dp, source_item, id_):
+        """Upload a file to an AWS distribution point in parts.
 
-        If a value differs between the recipe and the object, update
-        the object to reflect the change, and add the object to a
-        summary list.
+        An S3 multipart upload is started, or, if an earlier upload of
+        this version of the file was interrupted, resumed, so that only
+        the parts the bucket has not acknowledged are sent. Parts of
+        JSS_UPLOAD_CHUNK_SIZE bytes are uploaded
+        JSS_UPLOAD_PART_CONCURRENCY at a time. The upload ID and the
+        acknowledged parts are kept for the rest of the run, and with
+        JSS_UPLOAD_CHECKPOINT, in
+        '~/Library/AutoPkg/JSSImporter/upload_parts.json' for later runs.
 
         Args:
-            data: Recipe string value to enforce.
-            obj: JSSObject type to set data on.
-            path: String path to desired XML.
-            update: Summary list object to append obj to if something
-                is changed.
+            dp: python-jss AWS distribution point.
+            source_item: Path to the file to upload.
+            id_: ID of the package object, stored in the S3 object's
+                metadata as python-jss does.
         """
-        if data != obj.findtext(path):
-            obj.find(path).text = data
-            obj.save()
+        chunk_size = int(self.get_number("JSS_UPLOAD_CHUNK_SIZE"))
+        size = os.path.getsize(source_item)
+        part_numbers = range(1, max(1, -(-size // chunk_size)) + 1)
+        use_checkpoint = self.get_bool("JSS_UPLOAD_CHECKPOINT")
+        parts_path = os.path.join(STATE_DIR, "upload_parts.json")
+        key = "{} {}".format(
+            self.get_upload_checkpoint_key(source_item), self.get_dp_url(dp)
+        )
+
+        def save_state(state):
+            """Keep the upload's progress, or forget it if state is None."""
+            if state is None:
+                self.upload_parts.pop(key, None)
+            else:
+                self.upload_parts[key] = state
+            if use_checkpoint:
+                saved = self.read_json_file(parts_path)
+                if state is None:
+                    saved.pop(key, None)
+                else:
+                    saved[key] = state
+                self.write_json_file(parts_path, saved)
+
+        with STATE_FILE_LOCK:
+            state = self.upload_parts.get(key)
+            if state is None and use_checkpoint:
+                state = self.read_json_file(parts_path).get(key)
+        upload = None
+        if state and state["chunk_size"] == chunk_size:
+            for candidate in dp.bucket.list_multipart_uploads():
+                if candidate.id == state["upload_id"]:
+                    upload = candidate
+        if upload is None:
+            upload = dp.bucket.initiate_multipart_upload(
+                os.path.basename(source_item), metadata={"jamf-package-id": str(id_)}
+            )
+            state = {"upload_id": upload.id, "chunk_size": chunk_size, "parts": []}
+            with STATE_FILE_LOCK:
+                save_state(state)
+        else:
             self.output(
-                "{} '{}' updated.".format(str(obj.__class__).split(".")[-1][:-2], path)
+                "Resuming the upload to {} with {} of {} parts done.".format(
+                    self.get_dp_url(dp), len(state["parts"]), len(part_numbers)
+                )
             )
-            update.append(obj.name)
 
-    def copy(self, source_item, id_=-1):
-        """Copy a package or script using the JSS_REPOS preference."""
-        self.output("Copying {} to all distribution points.".format(source_item))
+        def upload_part(number):
+            """Upload a part, and record that the bucket has it."""
+            offset = (number - 1) * chunk_size
+            with open(source_item, "rb") as source:
+                source.seek(offset)
+                upload.upload_part_from_file(
+                    source, number, size=min(chunk_size, size - offset)
+                )
+            with STATE_FILE_LOCK:
+                state["parts"].append(number)
+                save_state(state)
 
-        def output_copy_status(connection):
-            """Output AutoPkg copying status."""
-            self.output("Copying to {}".format(connection["url"]))
+        pending = [number for number in part_numbers if number not in state["parts"]]
+        max_workers = min(
+            int(self.get_number("JSS_UPLOAD_PART_CONCURRENCY")), len(pending)
+        )
+        if max_workers > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [
+                    executor.submit(self.in_metrics_context(upload_part), number)
+                    for number in pending
+                ]
+                for future in futures:
+                    future.result()
+        else:
+            for number in pending:
+                upload_part(number)
+        upload.complete_upload()
+        with STATE_FILE_LOCK:
+            save_state(None)
+
+    def get_streaming_destination(self, dp, source_item):
+        """Return the path on a mounted share to stream source_item to.
+
+        Returns:
+            The path of the package in the share's Packages folder, or
+            None if the file must be copied by python-jss, because
+            JSS_STREAMING_COPY is not set, the distribution point is not
+            a mounted file share, or source_item is a bundle.
+        """
+        if not self.get_bool("JSS_STREAMING_COPY") or not os.path.isfile(source_item):
+            return None
+        mount_point = dp.connection.get("mount_point")
+        if not mount_point or not hasattr(dp, "is_mounted") or not dp.is_mounted():
+            return None
+        packages = os.path.join(mount_point, "Packages")
+        if not os.path.isdir(packages):
+            return None
+        return os.path.join(packages, os.path.basename(source_item))
+
+    def stream_copy(self, source_item, destination):
+        """Copy a file to a mounted share, verifying what was written.
+
+        The file is read once, in buffers of JSS_COPY_BUFFER_SIZE, and
+        hashed as it is written to a temporary file next to destination.
+        The temporary file is read back and its hash compared before it
+        is renamed into place, so a distribution point never has a
+        truncated or corrupt package under the real name. Copies are
+        throttled to JSS_COPY_BANDWIDTH_LIMIT megabytes per second.
 
-        self.jss.distribution_points.copy(
-            source_item, id_=id_, pre_callback=output_copy_status
+        Raises:
+            ProcessorError if the copy on the share does not match.
+        """
+        alignment = 64 * 1024
+        buffer_size = int(self.get_number("JSS_COPY_BUFFER_SIZE"))
+        buffer_size = max(alignment, -(-buffer_size // alignment) * alignment)
+        bytes_per_second = self.get_number("JSS_COPY_BANDWIDTH_LIMIT") * 1024 * 1024
+        buffer = bytearray(buffer_size)
+        view = memoryview(buffer)
+        temp_path = os.path.join(
+            os.path.dirname(destination),
+            ".{}.{}.tmp".format(os.path.basename(destination), os.getpid()),
         )
-        self.env["jss_changed_objects"]["jss_repo_updated"].append(
-            os.path.basename(source_item)
+
+        digest = hashlib.sha256()
+        copied = 0
+        start = time.time()
+        try:
+            with open(source_item, "rb") as source, open(temp_path, "wb") as target:
+                while True:
+                    length = source.readinto(buffer)
+                    if not length:
+                        break
+                    digest.update(view[:length])
+                    target.write(view[:length])
+                    copied += length
+                    if bytes_per_second:
+                        delay = copied / bytes_per_second - (time.time() - start)
+                        if delay > 0:
+                            time.sleep(delay)
+            written_digest = hashlib.sha256()
+            with open(temp_path, "rb") as target:
+                for chunk in iter(lambda: target.read(buffer_size), b""):
+                    written_digest.update(chunk)
+            if written_digest.hexdigest() != digest.hexdigest():
+                raise ProcessorError(
+                    "The copy of {} on {} does not match the original.".format(
+                        os.path.basename(source_item), os.path.dirname(destination)
+                    )
+                )
+            os.rename(temp_path, destination)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        # The package was hashed while copying, so it need not be again.
+        self.pkg_hashes[(source_item, "sha256")] = digest.hexdigest()
+        elapsed = max(time.time() - start, 0.001)
+        self.output(
+            "Streamed {} bytes to {} at {:.1f} MB/s".format(
+                copied, destination, copied / elapsed / 1024 / 1024
+            ),
+            verbose_level=2,
         )
-        self.output("Copied '{}'".format(source_item))
 
     def build_replace_dict(self):
         """Build dict of replacement values based on available input."""
@@ -805,6 +2754,9 @@ class JSSImporter(Processor):
         replace_dict["VERSION"] = self.version
         if self.package is not None:
             replace_dict["PKG_NAME"] = self.package.name
+        elif self.upload_future is not None:
+            # The package object is still being created by the upload.
+            replace_dict["PKG_NAME"] = self.pkg_name
         replace_dict["PROD_NAME"] = self.env.get("prod_name")
         if self.env.get("site_id"):
             replace_dict["SITE_ID"] = self.env.get("site_id")
@@ -839,6 +2791,7 @@ class JSSImporter(Processor):
         added_env="",
         update_env="",
         script_contents="",
+        replace_dict=None,
     ):
         """Check for an existing object and update it, or create a new
         object.
@@ -854,6 +2807,8 @@ class JSSImporter(Processor):
             update_env: The environment var to update if an object is
                 updated.
             script_contents (str): XML escaped script.
+            replace_dict: Text replacement values to use instead of
+                self.replace_dict.
             do_update (Boolean): Do not overwrite an existing group if
                 set to False.
 
@@ -861,7 +2816,7 @@ class JSSImporter(Processor):
             The recipe object after updating.
         """
         # Create a new object from the template
-        recipe_object = self.get_templated_object(obj_cls, template_path)
+        recipe_object = self.get_templated_object(obj_cls, template_path, replace_dict)
 
         # Ensure categories exist prior to using them in an object.
         # Text replacement has already happened, so categories should
@@ -880,7 +2835,7 @@ class JSSImporter(Processor):
         existing_object = None
         search_method = getattr(self.jss, obj_cls.__name__)
         try:
-            existing_object = search_method(name)
+            existing_object = self.get_object(obj_cls, name)
         except jss.GetError:
             pass
 
@@ -934,14 +2889,23 @@ class JSSImporter(Processor):
             tag = ElementTree.SubElement(recipe_object, "script_contents")
             tag.text = script_contents
 
-        if existing_object is not None:
+        if existing_object is not None and self.xml_contains(
+            recipe_object, existing_object
+        ):
+            # Nothing would change, so don't send the object at all.
+            self.output(
+                "{} '{}' is unchanged, skipping update.".format(obj_cls.__name__, name)
+            )
+            recipe_object = existing_object
+
+        elif existing_object is not None:
             # Update the existing object.
             # Copy the ID from the existing object to the new one so
             # that it knows how to save itself.
             recipe_object._basic_identity["id"] = existing_object.id
-            recipe_object.save()
+            self.save_object(recipe_object)
             # get feedback that the object has been created
-            object = self.wait_for_id(obj_cls, name)
+            object = self.wait_for_id(obj_cls, name, recipe_object)
             try:
                 object.id
                 # Retrieve the updated XML.
@@ -958,11 +2922,12 @@ class JSSImporter(Processor):
 
         else:
             # Object doesn't exist yet.
-            recipe_object.save()
+            self.save_object(recipe_object)
             # get feedback that the object has been created
-            object = self.wait_for_id(obj_cls, name)
+            object = self.wait_for_id(obj_cls, name, recipe_object)
             try:
                 object.id
+                self.add_to_inventory(object)
                 self.output("{} '{}' created.".format(obj_cls.__name__, name))
                 if added_env:
                     self.env["jss_changed_objects"][added_env].append(name)
@@ -976,7 +2941,95 @@ class JSSImporter(Processor):
         return recipe_object
 
     # pylint: enable=too-many-arguments
-    def get_templated_object(self, obj_cls, template_path):
+    def normalize_xml_text(self, text):  # pylint: disable=no-self-use
+        """Return element text with insignificant differences removed."""
+        text = (text or "").replace("\r\n", "\n").strip()
+        if text.lower() in ("true", "false"):
+            text = text.lower()
+        return text
+
+    def is_xml_collection(self, element):  # pylint: disable=no-self-use
+        """Return True if element is a list of like-named children.
+
+        The Classic API usually names list elements as the plural of
+        their members, e.g. computer_groups/computer_group or
+        criteria/criterion, but not always, e.g.
+        self_service_categories/category. Any element whose children
+        all share a tag, with more than one of them, is a list too.
+        """
+        tags = [child.tag for child in element if child.tag != "size"]
+        if not tags or len(set(tags)) != 1:
+            return False
+        tag = tags[0]
+        return (
+            len(tags) > 1
+            or element.tag in (tag + "s", tag + "es")
+            or (element.tag == "criteria" and tag == "criterion")
+        )
+
+    def xml_contains(self, wanted, existing):
+        """Return True if saving wanted would not change existing.
+
+        Compares the XML of a templated object with the object already
+        on the server. Fields that only the server sets are ignored, as
+        is whitespace, the order of list members and the IDs of
+        references that are also identified by name. Children which
+        repeat a tag, in either object, or which belong to a list, are
+        list members and must match one-to-one, since a PUT replaces
+        the whole list.
+
+        Args:
+            wanted: Element built from the recipe templates.
+            existing: Element retrieved from the Jamf Pro server.
+        """
+        existing_children = [child for child in existing if child.tag != "size"]
+        # References carry both an ID and a name; names are what the
+        # templates specify, and IDs may not be known yet.
+        has_name = wanted.find("name") is not None
+        wanted_children = [
+            child
+            for child in wanted
+            if child.tag != "size" and not (child.tag == "id" and has_name)
+        ]
+
+        if not len(wanted):
+            if existing_children:
+                # Sending an empty element may clear the existing data.
+                return False
+            return self.normalize_xml_text(wanted.text) == self.normalize_xml_text(
+                existing.text
+            )
+
+        is_collection = self.is_xml_collection(wanted) or self.is_xml_collection(
+            existing
+        )
+        if is_collection and set(child.tag for child in existing_children) - set(
+            child.tag for child in wanted_children
+        ):
+            return False
+
+        wanted_by_tag = OrderedDict()
+        for child in wanted_children:
+            wanted_by_tag.setdefault(child.tag, []).append(child)
+        for tag, children in wanted_by_tag.items():
+            candidates = [child for child in existing_children if child.tag == tag]
+            if not is_collection and len(children) == 1 and len(candidates) <= 1:
+                if not candidates or not self.xml_contains(children[0], candidates[0]):
+                    return False
+                continue
+            # List members, in any order.
+            if len(children) != len(candidates):
+                return False
+            for child in children:
+                for candidate in candidates:
+                    if self.xml_contains(child, candidate):
+                        candidates.remove(candidate)
+                        break
+                else:
+                    return False
+        return True
+
+    def get_templated_object(self, obj_cls, template_path, replace_dict=None):
         """Return an object based on a template located in search path.
 
         Args:
@@ -985,6 +3038,8 @@ class JSSImporter(Processor):
             template_path: String filename or path to template file.
                 See find_file_in_search_path() for more information on
                 file searching.
+            replace_dict: Text replacement values to use instead of
+                self.replace_dict.
 
         Returns:
             A JSS Object created based on the template,
@@ -998,11 +3053,146 @@ class JSSImporter(Processor):
         )
         final_template_path = self.find_file_in_search_path(template_path)
 
-        # Open and return a new object.
-        with open(final_template_path, "r") as template_file:
+        # Render and return a new object.
+        if replace_dict is None:
+            replace_dict = self.replace_dict
+        with self.timed("templates"):
+            parts, digest = self.get_template(final_template_path)
+            skeleton = self.get_template_skeleton(parts, digest)
+            if skeleton is not None:
+                element, unresolved = self.render_skeleton(skeleton, replace_dict)
+            else:
+                template, unresolved = self.render_template(parts, replace_dict)
+        if unresolved:
+            self.output(
+                "Unresolved placeholders in {}: {}".format(
+                    os.path.basename(final_template_path),
+                    ", ".join("%{}%".format(key) for key in sorted(set(unresolved))),
+                ),
+                verbose_level=2,
+            )
+        if skeleton is not None:
+            return obj_cls(self.jss, element)
+        try:
+            return obj_cls.from_string(self.jss, template)
+        except ElementTree.ParseError as error:
+            raise ProcessorError(
+                "{} is not valid XML after text replacement: {}".format(
+                    os.path.basename(final_template_path), error
+                )
+            )
+
+    def load_template(self, path):
+        """Return the compiled template at path."""
+        return self.get_template(path)[0]
+
+    def get_template(self, path):
+        """Return the compiled template at path and a digest of it.
+
+        Compiled templates are cached for the life of the process, and
+        recompiled if the file's modification time or size changes.
+        """
+        stat = os.stat(path)
+        with TEMPLATE_CACHE_LOCK:
+            cached = TEMPLATE_CACHE.get(path)
+        if cached is not None and cached[:2] == (stat.st_mtime, stat.st_size):
+            return cached[2:]
+        with open(path, "r") as template_file:
             text = template_file.read()
-        template = self.replace_text(text, self.replace_dict)
-        return obj_cls.from_string(self.jss, template)
+        parts = self.compile_template(text)
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        with TEMPLATE_CACHE_LOCK:
+            TEMPLATE_CACHE[path] = (stat.st_mtime, stat.st_size, parts, digest)
+        return parts, digest
+
+    def get_template_skeleton(self, parts, digest):
+        """Return a template parsed once, ready to be rendered.
+
+        A skeleton is the template's parsed XML, and a list of the
+        texts, tails and attribute values in it which contain % signs,
+        each compiled by compile_template(). Skeletons are shared by
+        every template file with the same contents.
+
+        Templates which can't be parsed before their placeholders are
+        replaced, or which have % signs outside of text, attribute
+        values and comments, are rendered as text instead, and None is
+        returned.
+        """
+        with TEMPLATE_CACHE_LOCK:
+            cached = digest in TEMPLATE_SKELETONS
+            skeleton = TEMPLATE_SKELETONS.get(digest)
+        with self.metrics_lock:
+            stats = self.metrics["templates"]
+            if skeleton is not None:
+                stats["hits"] += 1
+            elif cached:
+                stats["text"] += 1
+            else:
+                stats["misses"] += 1
+        if cached:
+            return skeleton
+
+        text = "%".join(parts)
+        try:
+            root = ElementTree.fromstring(text.encode("utf-8"))
+        except ElementTree.ParseError:
+            root = None
+        if root is not None:
+            slots = []
+            found = 0
+            for index, element in enumerate(root.iter()):
+                for field in ("text", "tail"):
+                    value = getattr(element, field)
+                    if value and "%" in value:
+                        slots.append((index, field, self.compile_template(value)))
+                        found += value.count("%")
+                for key, value in element.attrib.items():
+                    if "%" in value:
+                        slots.append((index, key, self.compile_template(value)))
+                        found += value.count("%")
+            # Rendering each value separately only matches rendering
+            # the whole text if every % sign is in one of them. Comments
+            # are dropped by the parser, placeholders and all.
+            if found == XML_COMMENT_RE.sub("", text).count("%"):
+                skeleton = (root, slots)
+        with TEMPLATE_CACHE_LOCK:
+            TEMPLATE_SKELETONS[digest] = skeleton
+        return skeleton
+
+    def render_skeleton(self, skeleton, replace_dict):
+        """Substitute values into a copy of a parsed template.
+
+        Values get the line ending and attribute whitespace
+        normalization the XML parser would have given them had they
+        been in the text of the template, and values with characters
+        the parser would have rejected are rejected.
+
+        Returns:
+            A tuple of the rendered root element and a list of tags
+            which look like placeholders but have no value.
+        """
+        root, slots = skeleton
+        root = deepcopy(root)
+        elements = list(root.iter())
+        unresolved = []
+        for index, field, parts in slots:
+            value, missing = self.render_template(
+                parts, replace_dict, escape_values=False
+            )
+            unresolved.extend(missing)
+            invalid = XML_INVALID_CHAR_RE.search(value)
+            if invalid:
+                raise ProcessorError(
+                    "Template values may not contain {!r}, which is not "
+                    "allowed in XML.".format(invalid.group())
+                )
+            value = value.replace("\r\n", "\n").replace("\r", "\n")
+            element = elements[index]
+            if field in ("text", "tail"):
+                setattr(element, field, value)
+            else:
+                element.set(field, value.replace("\t", " ").replace("\n", " "))
+        return root, unresolved
 
     def find_file_in_search_path(self, path):
         """Search search_paths for the first existing instance of path.
@@ -1060,9 +3250,9 @@ class JSSImporter(Processor):
             test_parent_folder_path = os.path.abspath(
                 os.path.join(search_dir, "..", filename)
             )
-            if os.path.exists(test_path):
+            if self.search_path_exists(test_path):
                 final_path = test_path
-            elif os.path.exists(test_parent_folder_path):
+            elif self.search_path_exists(test_parent_folder_path):
                 final_path = test_parent_folder_path
             tested.append(test_path)
             tested.append(test_parent_folder_path)
@@ -1083,7 +3273,33 @@ class JSSImporter(Processor):
 
         return final_path
 
-    def replace_text(self, text, replace_dict):  # pylint: disable=no-self-use
+    def search_path_exists(self, path):
+        """Return True if path exists, using a listing of its folder.
+
+        Each folder is listed once per run, so that repeated searches of
+        the same recipe folders, which may be on network volumes, don't
+        stat every candidate path.
+        """
+        folder, filename = os.path.split(path)
+        if folder not in self.dir_listings:
+            try:
+                names = os.listdir(folder)
+            except OSError:
+                names = []
+            self.dir_listings[folder] = (
+                set(names),
+                set(unicodedata.normalize("NFC", name).lower() for name in names),
+            )
+        names, folded_names = self.dir_listings[folder]
+        if filename in names:
+            return True
+        # Case-insensitive and normalizing file systems, as on macOS,
+        # also match other spellings of the name.
+        return unicodedata.normalize(
+            "NFC", filename
+        ).lower() in folded_names and os.path.exists(path)
+
+    def replace_text(self, text, replace_dict):
         """Substitute items in a text string. Also escapes for XML,
         as this is the only use for this definition
 
@@ -1096,11 +3312,64 @@ class JSSImporter(Processor):
         Returns:
             The text after replacement.
         """
-        for key in replace_dict:
-            # Wrap our keys in % to match template tags.
-            value = escape(replace_dict[key])
-            text = text.replace("%%%s%%" % key, value)
-        return text
+        return self.render_template(self.compile_template(text), replace_dict)[0]
+
+    def compile_template(self, text):  # pylint: disable=no-self-use
+        """Split text into the pieces between % signs.
+
+        Every odd-numbered piece that is followed by another piece was
+        enclosed in % signs, and so may be a %tag%.
+
+        Returns:
+            A tuple of strings for render_template().
+        """
+        return tuple(text.split("%"))
+
+    def render_template(
+        self, parts, replace_dict, escape_values=True
+    ):  # pylint: disable=no-self-use
+        """Substitute values into a compiled template in a single pass.
+
+        Tags are matched from left to right. Values are only XML escaped
+        if their tag is used, and only once per render.
+
+        Args:
+            parts: A template compiled by compile_template().
+            replace_dict: A dict, where
+                key: Corresponds to the % delimited tag in text.
+                value: Text to swap in.
+            escape_values: Whether to XML escape values, as needed
+                when the template is XML text rather than the value of
+                a parsed element.
+
+        Returns:
+            A tuple of the text after replacement and a list of tags
+            which look like placeholders but have no value.
+        """
+        output = [parts[0]]
+        escaped = {}
+        unresolved = []
+        index = 1
+        while index < len(parts):
+            key = parts[index]
+            enclosed = index + 1 < len(parts)
+            if enclosed and key in replace_dict:
+                if key not in escaped:
+                    escaped[key] = (
+                        escape(replace_dict[key])
+                        if escape_values
+                        else replace_dict[key]
+                    )
+                output.append(escaped[key])
+                output.append(parts[index + 1])
+                index += 2
+            else:
+                if enclosed and PLACEHOLDER_RE.match(key):
+                    unresolved.append(key)
+                output.append("%")
+                output.append(key)
+                index += 1
+        return "".join(output), unresolved
 
     def validate_input_var(self, var):  # pylint: disable=no-self-use
         """Validate the value before trying to add a group.
@@ -1126,20 +3395,27 @@ class JSSImporter(Processor):
             invalid = True
         return False if invalid else True
 
-    def add_or_update_smart_group(self, group):
-        """Either add a new group or update existing group."""
-        # Build the template group object
-        self.replace_dict["group_name"] = group["name"]
+    def get_group_replacements(self, group):  # pylint: disable=no-self-use
+        """Return the text replacement values specific to a group."""
+        replacements = {"group_name": group["name"]}
         if group.get("site_id"):
-            self.replace_dict["site_id"] = group.get("site_id")
+            replacements["site_id"] = group.get("site_id")
         if group.get("site_name"):
-            self.replace_dict["site_name"] = group.get("site_name")
+            replacements["site_name"] = group.get("site_name")
+        return replacements
+
+    def add_or_update_smart_group(self, group):
+        """Either add a new group or update existing group."""
+        # Build the template group object. Groups may be processed at
+        # the same time, so each gets its own replacement values.
+        replace_dict = dict(self.replace_dict)
+        replace_dict.update(self.get_group_replacements(group))
 
         # If do_update is set to False, do not update this object
         do_update = group.get("do_update", True)
         if not do_update:
             try:
-                computer_group = self.jss.ComputerGroup(group["name"])
+                computer_group = self.get_object(jss.ComputerGroup, group["name"])
                 self.output(
                     "Computer Group '%s' already exists "
                     "and set not to update." % computer_group.name
@@ -1156,6 +3432,7 @@ class JSSImporter(Processor):
             group["template_path"],
             update_env="jss_group_updated",
             added_env="jss_group_added",
+            replace_dict=replace_dict,
         )
         return computer_group
 
@@ -1163,13 +3440,14 @@ class JSSImporter(Processor):
         """Either add a new group or update existing group."""
         # Check for pre-existing group first
         try:
-            computer_group = self.jss.ComputerGroup(group["name"])
+            computer_group = self.get_object(jss.ComputerGroup, group["name"])
             self.output(
                 "Static Computer Group: {} already exists.".format(computer_group.name)
             )
         except jss.GetError:
             computer_group = jss.ComputerGroup(self.jss, group["name"])
-            computer_group.save()
+            self.save_object(computer_group)
+            self.add_to_inventory(computer_group)
             self.output(
                 "Static Computer Group '{}' created.".format(computer_group.name)
             )
@@ -1202,6 +3480,8 @@ class JSSImporter(Processor):
 
     def add_package_to_policy(self, policy_template):
         """Add a package to a self service policy."""
+        # The policy must not refer to a package before it is uploaded.
+        self.finish_upload()
         if self.package is not None:
             self.ensure_xml_structure(policy_template, "package_configuration/packages")
             action_type = self.env["policy_action_type"]
@@ -1223,6 +3503,110 @@ class JSSImporter(Processor):
             return self.ensure_xml_structure(element.find(search), path)
         return element
 
+    @contextmanager
+    def timed(self, phase):
+        """Add the wall time spent in a with block to a phase's total."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_phase_time(phase, time.time() - start)
+
+    def add_phase_time(self, phase, seconds):
+        """Add seconds to the total wall time of a phase."""
+        with self.metrics_lock:
+            phases = self.metrics["phases"]
+            phases[phase] = phases.get(phase, 0) + seconds
+
+    def in_metrics_context(self, function):
+        """Wrap function so requests it makes in other threads count here."""
+
+        def wrapper(*args, **kwargs):
+            """Call function with this processor's metrics in context."""
+            METRICS_CONTEXT.processor = self
+            return function(*args, **kwargs)
+
+        return wrapper
+
+    def instrument_session(self):
+        """Count the requests made through the python-jss session.
+
+        The session may be shared between recipes, so requests are
+        counted towards the JSSImporter in METRICS_CONTEXT for the
+        thread that makes them.
+        """
+        session = getattr(self.jss, "session", None)
+        if session is None or getattr(session, "jssimporter_instrumented", False):
+            return
+        for method in ("get", "post", "put", "delete"):
+            request = getattr(session, method, None)
+            if request is not None:
+                setattr(session, method, self.count_requests(method.upper(), request))
+        session.jssimporter_instrumented = True
+
+    @staticmethod
+    def count_requests(method, request):
+        """Return request wrapped to record its count, time and bytes."""
+
+        def wrapper(url, *args, **kwargs):
+            """Make the request and record it."""
+            start = time.time()
+            response = request(url, *args, **kwargs)
+            processor = getattr(METRICS_CONTEXT, "processor", None)
+            if processor is not None:
+                processor.record_request(
+                    method, url, kwargs.get("data"), response, time.time() - start
+                )
+            return response
+
+        return wrapper
+
+    def record_request(self, method, url, data, response, seconds):
+        """Add a request to the metrics for its method and endpoint."""
+        path = url.split("?")[0].split("://")[-1].partition("/")[2]
+        if "JSSResource/" in path:
+            path = path.split("JSSResource/")[1]
+        endpoint = "{} {}".format(method, path.split("/")[0])
+        content = getattr(response, "content", None)
+        with self.metrics_lock:
+            stats = self.metrics["requests"].setdefault(
+                endpoint,
+                {"count": 0, "seconds": 0.0, "bytes_sent": 0, "bytes_received": 0},
+            )
+            stats["count"] += 1
+            stats["seconds"] += seconds
+            if isinstance(data, (bytes, basestring)):
+                stats["bytes_sent"] += len(data)
+            if isinstance(content, (bytes, basestring)):
+                stats["bytes_received"] += len(content)
+
+    def publish_metrics(self, total_seconds):
+        """Set jss_importer_metrics and optionally append it to a file."""
+        with self.metrics_lock:
+            metrics = deepcopy(self.metrics)
+        metrics["total_seconds"] = total_seconds
+        metrics["requests_total"] = sum(
+            stats["count"] for stats in metrics["requests"].values()
+        )
+        self.env["jss_importer_metrics"] = metrics
+        self.output(
+            "Completed in {:.1f} seconds with {} requests to the Jamf Pro "
+            "server.".format(total_seconds, metrics["requests_total"]),
+            verbose_level=2,
+        )
+
+        metrics_file = self.env.get("JSS_METRICS_FILE")
+        if metrics_file:
+            record = {
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "name": self.env.get("NAME"),
+                "version": self.version,
+                "metrics": metrics,
+            }
+            with STATE_FILE_LOCK:
+                with open(os.path.expanduser(metrics_file), "a") as metrics_handle:
+                    metrics_handle.write(json.dumps(record, sort_keys=True) + "\n")
+
     def get_report_string(self, items):  # pylint: disable=no-self-use
         """Return human-readable string from a list of Jamf Pro API objects."""
         return ", ".join(set(items))
@@ -1233,7 +3617,11 @@ class JSSImporter(Processor):
         if any(value for value in self.env["jss_changed_objects"].values()):
             # Create a blank summary.
             self.env["jss_importer_summary_result"] = {
-                "summary_text": "The following changes were made to the Jamf Pro Server:",
+                "summary_text": (
+                    "The following changes would be made to the Jamf Pro Server:"
+                    if self.get_bool("JSS_DRY_RUN")
+                    else "The following changes were made to the Jamf Pro Server:"
+                ),
                 "report_fields": [
                     "Name",
                     "Package",
@@ -1306,22 +3694,106 @@ class JSSImporter(Processor):
             if jss_package_uploaded:
                 data["Package_Uploaded"] = "True"
 
-    def main(self):
-        """Main processor code."""
-        # Ensure we have the right version of python-jss
-        python_jss_version = StrictVersion(PYTHON_JSS_VERSION)
-        self.output(
-            "python-jss version: {}.".format(python_jss_version),
-            verbose_level=2,
-        )
-        if python_jss_version < REQUIRED_PYTHON_JSS_VERSION:
+    def mount_distribution_points(self):
+        """Mount the file share distribution points which aren't mounted.
+
+        Returns:
+            A list of the distribution points which were mounted.
+        """
+        mounted = []
+        for dp in self.jss.distribution_points:
             self.output(
-                "python-jss version is too old. Please update to version: {}.".format(
-                    REQUIRED_PYTHON_JSS_VERSION
-                )
+                "Checking if DP already mounted...",
+                verbose_level=2,
             )
-            raise ProcessorError
+            if hasattr(dp, "is_mounted") and not dp.is_mounted():
+                dp.mount()
+                mounted.append(dp)
+        return mounted
+
+    def unmount_distribution_points(self, dps):
+        """Unmount distribution points returned by mount_distribution_points."""
+        for dp in dps:
+            self.output(
+                "Unmounting DP...",
+                verbose_level=2,
+            )
+            dp.umount()
+
+    @classmethod
+    def run_batch(cls, envs, max_workers=1):
+        """Run JSSImporter for several recipes with one session and mount.
+
+        Every recipe reuses the same Jamf Pro session, and distribution
+        points are mounted once before the first recipe and unmounted
+        after the last, rather than by each recipe. Each recipe keeps
+        the session whose distribution points were mounted for it, even
+        if the session has since passed JSS_SESSION_MAX_AGE.
+
+        Args:
+            envs: A list of AutoPkg env dicts, one per recipe, or the
+                path to a plist containing such a list. Input variables
+                missing from an env take their default values.
+            max_workers: Number of recipes to process at the same time.
+
+        Returns:
+            The list of envs after processing. If a recipe failed, its
+            env has the error message in "jss_importer_error".
+        """
+        if isinstance(envs, basestring):
+            with open(envs, "rb") as plist_file:
+                envs = plistlib.load(plist_file)
+
+        processors = []
+        for env in envs:
+            env = dict(env)
+            for key, value in cls.input_variables.items():
+                if key not in env and "default" in value:
+                    env[key] = deepcopy(value["default"])
+            env["JSS_REUSE_SESSION"] = True
+            processors.append(cls(env))
+
+        # Mount the distribution points of each server once, and keep
+        # the recipes from mounting and unmounting them, or from
+        # replacing the session they were mounted for.
+        sessions = []
+        mounting = []
+        for processor in processors:
+            processor.create_jss()
+            processor.manage_mounts = False
+            if processor.jss not in sessions:
+                sessions.append(processor.jss)
+                mounting.append(processor)
+        mounted = []
+        if any(processor.env["pkg_path"] for processor in processors):
+            for processor in mounting:
+                mounted.append((processor, processor.mount_distribution_points()))
+
+        def run(processor):
+            """Run one recipe, recording rather than raising errors."""
+            try:
+                processor.main()
+            except Exception as error:  # pylint: disable=broad-except
+                processor.output(
+                    "JSSImporter failed for {}: {}".format(
+                        processor.env.get("NAME") or processor.env.get("prod_name"),
+                        error,
+                    )
+                )
+                processor.env["jss_importer_error"] = "{}".format(error)
+            return processor.env
 
+        try:
+            if max_workers > 1:
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    return list(executor.map(run, processors))
+            return [run(processor) for processor in processors]
+        finally:
+            for processor, dps in mounted:
+                processor.unmount_distribution_points(dps)
+
+    def main(self):
+        """Main processor code."""
         self.output(
             "JSSImporter version: {}.".format(__version__),
             verbose_level=2,
@@ -1331,11 +3803,8 @@ class JSSImporter(Processor):
         if "jss_importer_summary_result" in self.env:
             del self.env["jss_importer_summary_result"]
 
-        self.create_jss()
-        # JSSUser object is deprecated so this value is always empty
-        # self.output(
-        #     "Jamf Pro version: '{}'".format(self.jss.version()), verbose_level=2,
-        # )
+        METRICS_CONTEXT.processor = self
+        start = time.time()
 
         self.pkg_name = os.path.basename(self.env["pkg_path"])
         self.prod_name = self.env["prod_name"]
@@ -1349,65 +3818,118 @@ class JSSImporter(Processor):
                 verbose_level=2,
             )
 
+        # define whether we will stop based on the value of STOP_IF_NO_JSS_UPLOAD
+        self.stop_if_no_upload = "{}".format(self.env.get("STOP_IF_NO_JSS_UPLOAD"))
+
         # Build and init jss_changed_objects
         self.init_jss_changed_objects()
 
-        self.category = self.handle_category("category")
-        self.policy_category = self.handle_category("policy_category")
+        # Skip recipes whose inputs are unchanged since they were last
+        # published, without connecting to the server.
+        recipe_inputs = None
+        if self.get_bool("JSS_STATE_CACHE") and not self.get_bool("JSS_DRY_RUN"):
+            recipe_inputs = self.get_recipe_inputs()
+            if self.recipe_state_unchanged(recipe_inputs):
+                self.output(
+                    "Nothing has changed since {} was last published.".format(
+                        self.get_recipe_state_key()
+                    )
+                )
+                if self.stop_if_no_upload != "False":
+                    self.env["stop_processing_recipe"] = True
+                self.summarize()
+                self.publish_metrics(time.time() - start)
+                return
+
+        # Ensure we have the right version of python-jss. It is only
+        # imported now, as recipes skipped above don't need it.
+        with self.timed("import"):
+            try:
+                python_jss_version = StrictVersion(jss.__version__)
+            except (ImportError, AttributeError):
+                python_jss_version = StrictVersion("0.0.0")
+        self.output(
+            "python-jss version: {}.".format(python_jss_version),
+            verbose_level=2,
+        )
+        if python_jss_version < REQUIRED_PYTHON_JSS_VERSION:
+            self.output(
+                "python-jss version is too old. Please update to version: {}.".format(
+                    REQUIRED_PYTHON_JSS_VERSION
+                )
+            )
+            raise ProcessorError
+
+        with self.timed("connect"):
+            # run_batch connects its recipes before mounting their shares.
+            if self.jss is None:
+                self.create_jss()
+            self.instrument_session()
+            if self.get_bool("JSS_PRELOAD_INVENTORY"):
+                self.preload_inventory()
+        # JSSUser object is deprecated so this value is always empty
+        # self.output(
+        #     "Jamf Pro version: '{}'".format(self.jss.version()), verbose_level=2,
+        # )
+
+        if self.get_bool("JSS_DRY_RUN"):
+            self.output("Dry run: no changes will be made to the Jamf Pro server.")
+            self.init_plan()
+
+        with self.timed("categories"):
+            self.category = self.handle_category("category")
+            self.policy_category = self.handle_category("policy_category")
 
         # Get our DPs ready for copying.
         if len(self.jss.distribution_points) == 0:
             self.output("Warning: No distribution points configured!")
-        for dp in self.jss.distribution_points:
-            self.output(
-                "Checking if DP already mounted...",
-                verbose_level=2,
-            )
-            dp.was_mounted = hasattr(dp, "is_mounted") and dp.is_mounted()
         # Don't bother mounting the DPs if there's no package.
-        if self.env["pkg_path"]:
-            self.jss.distribution_points.mount()
-
-        # define whether we will stop based on the value of STOP_IF_NO_JSS_UPLOAD
-        self.stop_if_no_upload = "{}".format(self.env.get("STOP_IF_NO_JSS_UPLOAD"))
+        if self.env["pkg_path"] and self.manage_mounts:
+            with self.timed("mount"):
+                self.mounted_dps = self.mount_distribution_points()
 
         # handle package
-        self.package = self.handle_package(self.stop_if_no_upload)
+        with self.timed("package"):
+            self.package = self.handle_package(self.stop_if_no_upload)
 
         # stop if no package was uploaded and STOP_IF_NO_JSS_UPLOAD is True
         if self.stop_if_no_upload != "False" and not self.upload_needed:
+            self.finish_upload()
             # Done with DPs, unmount them.
-            for dp in self.jss.distribution_points:
-                if not dp.was_mounted:
-                    self.output(
-                        "Unmounting DP...",
-                        verbose_level=2,
-                    )
-                    self.jss.distribution_points.umount()
+            with self.timed("unmount"):
+                self.unmount_distribution_points(self.mounted_dps)
+            if recipe_inputs is not None:
+                self.refresh_recipe_state(recipe_inputs)
             self.summarize()
+            self.publish_metrics(time.time() - start)
             return
 
         # Build our text replacement dictionary
         self.build_replace_dict()
 
-        self.extattrs = self.handle_extension_attributes()
-
-        self.groups = self.handle_groups(self.env.get("groups"))
-        self.exclusion_groups = self.handle_groups(self.env.get("exclusion_groups"))
-
-        self.scripts = self.handle_scripts()
-        self.policy = self.handle_policy()
-        self.handle_icon()
+        with self.timed("objects"):
+            self.handle_policy_objects()
+        with self.timed("policy"):
+            self.policy = self.handle_policy()
+        with self.timed("icon"):
+            self.handle_icon()
+        self.finish_upload()
 
         # Done with DPs, unmount them.
-        for dp in self.jss.distribution_points:
-            if not dp.was_mounted:
-                self.jss.distribution_points.umount()
+        with self.timed("unmount"):
+            self.unmount_distribution_points(self.mounted_dps)
+        if recipe_inputs is not None:
+            self.record_recipe_state(recipe_inputs)
         self.summarize()
+        self.publish_metrics(time.time() - start)
 
 
 # pylint: enable=too-many-instance-attributes, too-many-public-methods
 
 if __name__ == "__main__":
-    processor = JSSImporter()  # pylint: disable=invalid-name
-    processor.execute_shell()
+    if len(sys.argv) > 2 and sys.argv[1] == "--batch":
+        # JSSImporter.py --batch envs.plist [max_workers]
+        JSSImporter.run_batch(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 1)
+    else:
+        processor = JSSImporter()  # pylint: disable=invalid-name
+        processor.execute_shell()
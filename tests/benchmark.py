@@ -0,0 +1,197 @@
+"""Measure JSSImporter against a FakeJamf server.
+
+Each scenario prints the wall time it took and, for runs of
+JSSImporter.main, the requests made and the bytes sent and received.
+The server can be made slower than a local one with --latency, and to
+hide new objects for a while with --id-delay.
+
+Usage:
+    python tests/benchmark.py [--latency SECONDS] [--id-delay SECONDS]
+        [--runs N] [scenario ...]
+"""
+
+from __future__ import absolute_import, print_function
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from distutils.version import StrictVersion
+from xml.sax.saxutils import escape
+
+from fake_jamf import FakeJamf
+from support import build_env, jssimporter
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def report(name, seconds, **values):
+    """Print a line of results."""
+    details = "".join(" {}={}".format(key, value) for key, value in values.items())
+    print("{:<24} {:>8.3f}s{}".format(name, seconds, details))
+
+
+def run_main(server, root, **overrides):
+    """Run JSSImporter.main, and report its requests and bytes."""
+    processor = jssimporter.JSSImporter(build_env(server.url, root, **overrides))
+    start = time.time()
+    processor.main()
+    seconds = time.time() - start
+    requests = processor.env["jss_importer_metrics"]["requests"].values()
+    return seconds, {
+        "requests": sum(stats["count"] for stats in requests),
+        "sent": sum(stats["bytes_sent"] for stats in requests),
+        "received": sum(stats["bytes_received"] for stats in requests),
+    }
+
+
+def bench_main(args, root):
+    """Run a recipe on an empty server, again unchanged, then as a dry run."""
+    server = FakeJamf(latency=args.latency).start()
+    try:
+        for name, overrides in (
+            ("main: first run", {}),
+            ("main: unchanged", {"STOP_IF_NO_JSS_UPLOAD": "False"}),
+            ("main: early stop", {}),
+            (
+                "main: dry run",
+                {"JSS_DRY_RUN": True, "STOP_IF_NO_JSS_UPLOAD": "False", "version": "2"},
+            ),
+        ):
+            seconds, values = run_main(server, root, **overrides)
+            report(name, seconds, **values)
+    finally:
+        server.stop()
+
+
+def bench_wait_for_id(args, root):
+    """Wait for the ID of an object the server is slow to show."""
+    server = FakeJamf(latency=args.latency, id_delay=args.id_delay).start()
+    try:
+        processor = jssimporter.JSSImporter(build_env(server.url, root))
+        processor.create_jss()
+        server.add("packages", "<package><name>Slow.pkg</name></package>")
+        start = time.time()
+        processor.wait_for_id(jssimporter.jss.Package, "Slow.pkg")
+        report(
+            "wait_for_id",
+            time.time() - start,
+            polls=server.count("GET", "packages/name/Slow.pkg"),
+        )
+    finally:
+        server.stop()
+
+
+def bench_zip(args, root):
+    """Zip a synthetic bundle with one worker and with one per CPU.
+
+    The bundle is then zipped again with a fingerprint, and once more
+    unchanged.
+    """
+    bundle = os.path.join(root, "Bundle.pkg")
+    for index in range(args.zip_files):
+        folder = os.path.join(bundle, "Contents", "Resources", str(index % 10))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(os.path.join(folder, "file{}".format(index)), "wb") as member:
+            member.write(os.urandom(args.zip_file_size // 2) * 2)
+    size = args.zip_files * args.zip_file_size / 1e6
+    for name, overrides in (
+        ("zip: 1 worker", {"JSS_ZIP_WORKERS": 1, "JSS_ZIP_REUSE": False}),
+        ("zip: 1 per CPU", {"JSS_ZIP_REUSE": False}),
+        ("zip: new", {}),
+        ("zip: unchanged", {}),
+    ):
+        processor = jssimporter.JSSImporter(
+            build_env("http://unused", root, **overrides)
+        )
+        start = time.time()
+        processor.zip_pkg_path(bundle)
+        seconds = time.time() - start
+        report(name, seconds, mb_per_second="{:.1f}".format(size / seconds))
+
+
+def replace_text_per_key(text, replace_dict):
+    """Render a template the way JSSImporter did before it compiled them."""
+    for key, value in replace_dict.items():
+        text = text.replace("%{}%".format(key), escape(value))
+    return text
+
+
+def bench_templates(args, root):
+    """Render the example policy template with a large env."""
+    processor = jssimporter.JSSImporter(build_env("http://unused", root))
+    processor.build_replace_dict()
+    replace_dict = {
+        key: value for key, value in processor.replace_dict.items() if value
+    }
+    replace_dict.update(("ENV_KEY_{}".format(i), "value") for i in range(500))
+    path = os.path.join(processor.env["RECIPE_DIR"], "PolicyTemplate.xml")
+    with open(path) as template_file:
+        text = template_file.read() * 20
+
+    start = time.time()
+    for _ in range(args.runs * 100):
+        replace_text_per_key(text, replace_dict)
+    report("templates: per key", time.time() - start)
+
+    parts = processor.compile_template(text)
+    start = time.time()
+    for _ in range(args.runs * 100):
+        processor.render_template(parts, replace_dict)
+    report("templates: compiled", time.time() - start)
+
+
+def bench_import(args, _):
+    """Import JSSImporter in a new process, with and without python-jss."""
+    for name, code in (
+        ("import", "import support"),
+        ("import with jss", "import support; support.jssimporter.load_jss()"),
+    ):
+        start = time.time()
+        for _ in range(args.runs):
+            subprocess.check_call([sys.executable, "-c", code], cwd=TESTS_DIR)
+        report(name, (time.time() - start) / args.runs)
+
+
+SCENARIOS = {
+    "main": bench_main,
+    "wait_for_id": bench_wait_for_id,
+    "zip": bench_zip,
+    "templates": bench_templates,
+    "import": bench_import,
+}
+
+
+def main():
+    """Run the chosen scenarios, each in a new folder."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "scenarios", nargs="*", help="any of: {}".format(", ".join(sorted(SCENARIOS)))
+    )
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--id-delay", type=float, default=1.0)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--zip-files", type=int, default=200)
+    parser.add_argument("--zip-file-size", type=int, default=256 * 1024)
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error("unknown scenarios: {}".format(", ".join(sorted(unknown))))
+
+    jssimporter.REQUIRED_PYTHON_JSS_VERSION = StrictVersion("2.1.0")
+    for name in args.scenarios or sorted(SCENARIOS):
+        root = tempfile.mkdtemp()
+        jssimporter.STATE_DIR = os.path.join(root, "state")
+        jssimporter.JSS_SESSIONS.clear()
+        jssimporter.INVENTORY_CACHE.clear()
+        try:
+            SCENARIOS[name](args, root)
+        finally:
+            shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Fixtures for running JSSImporter against a FakeJamf server.
+
+The tests need python-jss, and a Python it supports; python-jss 2.1
+uses Element.getchildren(), which was removed in Python 3.9, so the
+tests are skipped on later versions.
+"""
+
+from __future__ import absolute_import
+import os
+import sys
+from distutils.version import StrictVersion
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from support import build_env, jssimporter  # pylint: disable=wrong-import-position
+from fake_jamf import FakeJamf  # pylint: disable=wrong-import-position
+
+# python-jss 2.1.1 is only distributed in the JSSImporter package, and the
+# latest release on PyPI is 2.1.0. 2.1.1 changed uploads to cloud
+# distribution points, which the tests don't use, so 2.1.0 is accepted.
+PYPI_PYTHON_JSS_VERSION = StrictVersion("2.1.0")
+
+
+def pytest_collection_modifyitems(items):
+    """Skip every test on a Python that python-jss 2.1 doesn't support."""
+    if sys.version_info >= (3, 9):
+        skip = pytest.mark.skip(reason="python-jss 2.1 needs Python 3.8 or earlier")
+        for item in items:
+            item.add_marker(skip)
+
+
+@pytest.fixture(autouse=True)
+def isolated_state(tmp_path, monkeypatch):
+    """Keep local state files, caches and sessions private to each test."""
+    monkeypatch.setattr(jssimporter, "STATE_DIR", str(tmp_path / "state"))
+    monkeypatch.setattr(jssimporter, "COOKIE_JAR", str(tmp_path / "cookies"))
+    jssimporter.load_jss()
+    if StrictVersion(jssimporter.jss.__version__) == PYPI_PYTHON_JSS_VERSION:
+        monkeypatch.setattr(
+            jssimporter, "REQUIRED_PYTHON_JSS_VERSION", PYPI_PYTHON_JSS_VERSION
+        )
+    jssimporter.JSS_SESSIONS.clear()
+    jssimporter.INVENTORY_CACHE.clear()
+    yield
+    jssimporter.JSS_SESSIONS.clear()
+    jssimporter.INVENTORY_CACHE.clear()
+
+
+@pytest.fixture
+def server():
+    """A running FakeJamf."""
+    fake = FakeJamf().start()
+    yield fake
+    fake.stop()
+
+
+@pytest.fixture
+def make_env(tmp_path, server):
+    """Return a function building a recipe env for the FakeJamf."""
+
+    def make(**overrides):
+        return build_env(server.url, str(tmp_path), **overrides)
+
+    make.repo = str(tmp_path / "repo")
+    make.recipe_dir = str(tmp_path / "recipe")
+    make.pkg_path = str(tmp_path / "Example-1.0.pkg")
+    make()  # Create the repo, recipe folder and package.
+    return make
+
+
+@pytest.fixture
+def run(make_env):
+    """Return a function running JSSImporter with an env from make_env."""
+
+    def run_processor(**overrides):
+        processor = jssimporter.JSSImporter(make_env(**overrides))
+        processor.main()
+        return processor
+
+    return run_processor
@@ -0,0 +1,353 @@
+"""A stand-in Jamf Pro server implementing enough of the Classic API for JSSImporter.
+
+Objects are kept in memory, keyed by endpoint and ID. Every request is
+logged, and the server can be made slow, made to hide new objects for a
+while, as a JDS does while it assigns IDs, or made to fail requests.
+Paths under /s3/ implement the S3 multipart upload requests, for a
+stand-in AWS distribution point bucket.
+
+Usage:
+    server = FakeJamf(latency=0.05)
+    server.start()
+    ... point JSS_URL at server.url ...
+    server.stop()
+"""
+
+from __future__ import absolute_import
+import re
+import threading
+import time
+from xml.etree import ElementTree
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl, unquote
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+    from urlparse import parse_qsl
+
+
+# Classic API endpoints, with the tags of their list and object elements.
+ENDPOINTS = {
+    "categories": ("categories", "category"),
+    "computerextensionattributes": (
+        "computer_extension_attributes",
+        "computer_extension_attribute",
+    ),
+    "computergroups": ("computer_groups", "computer_group"),
+    "distributionpoints": ("distribution_points", "distribution_point"),
+    "packages": ("packages", "package"),
+    "policies": ("policies", "policy"),
+    "scripts": ("scripts", "script"),
+}
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """HTTPServer handling each request in a thread."""
+
+    daemon_threads = True
+
+
+class FakeJamf(object):
+    """An in-memory Jamf Pro server.
+
+    Attributes:
+        latency: Seconds each request takes.
+        id_delay: Seconds after an object is created during which it
+            can't be found by name.
+        requests: List of (method, path, bytes received) for every
+            request made.
+        objects: Dict of endpoint to dict of ID to Element.
+        uploads: List of (policy ID, filename, bytes) of uploaded icons.
+        icons: Dict of icon ID to the filename it was uploaded with.
+        s3_uploads: Dict of multipart upload ID to a dict with the
+            object's key and a dict of part number to bytes.
+        s3_objects: Dict of S3 object key to the bytes of the object.
+    """
+
+    def __init__(self, latency=0.0, id_delay=0.0):
+        self.latency = latency
+        self.id_delay = id_delay
+        self.requests = []
+        self.objects = {endpoint: {} for endpoint in ENDPOINTS}
+        self.visible_after = {}
+        self.uploads = []
+        self.icons = {}
+        self.s3_uploads = {}
+        self.s3_objects = {}
+        self.next_upload_id = 1
+        self.failures = []
+        self.next_id = 1
+        self.next_icon_id = 1
+        self.lock = threading.Lock()
+        self.httpd = None
+        self.thread = None
+
+    @property
+    def url(self):
+        """The base URL of the running server."""
+        return "http://127.0.0.1:{}".format(self.httpd.server_address[1])
+
+    def start(self):
+        """Serve requests in a background thread."""
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """Dispatch each request to the FakeJamf."""
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                """Keep test output quiet."""
+
+            def handle_request(self):
+                """Read the body, and send the FakeJamf's response."""
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                status, content = server.respond(self.command, self.path, body)
+                self.send_response(status)
+                self.send_header("Content-Type", "text/xml;charset=UTF-8")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving."""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def fail(self, method, pattern, status=500, times=1):
+        """Make the next requests matching method and path pattern fail.
+
+        Args:
+            method: HTTP method, e.g. "GET".
+            pattern: Regular expression searched for in the request path.
+            status: HTTP status to respond with.
+            times: Number of requests to fail.
+        """
+        with self.lock:
+            self.failures.append([method, re.compile(pattern), status, times])
+
+    def count(self, method=None, pattern=""):
+        """Return the number of logged requests matching method and pattern."""
+        return len(
+            [
+                request
+                for request in self.requests
+                if (method is None or request[0] == method)
+                and re.search(pattern, request[1])
+            ]
+        )
+
+    def add(self, endpoint, xml, delay=None):
+        """Create an object from XML text, as a POST would.
+
+        Args:
+            endpoint: Classic API endpoint, e.g. "packages".
+            xml: XML text or Element of the object.
+            delay: Seconds the object can't be found by name, or None
+                to use id_delay.
+
+        Returns:
+            The new object's Element.
+        """
+        element = ElementTree.fromstring(xml) if not hasattr(xml, "tag") else xml
+        with self.lock:
+            id_ = self.next_id
+            self.next_id += 1
+            id_element = self.find_id_element(element)
+            id_element.text = str(id_)
+            if endpoint == "policies":
+                self.resolve_icon(element)
+            self.objects[endpoint][id_] = element
+            self.visible_after[(endpoint, id_)] = time.time() + (
+                self.id_delay if delay is None else delay
+            )
+        return element
+
+    def get(self, endpoint, name):
+        """Return the Element of an object by name, or None."""
+        for element in self.objects[endpoint].values():
+            if self.get_name(element) == name:
+                return element
+        return None
+
+    @staticmethod
+    def find_id_element(element):
+        """Return the id Element of an object, adding it if missing."""
+        parent = element.find("general")
+        if parent is None:
+            parent = element
+        id_element = parent.find("id")
+        if id_element is None:
+            id_element = ElementTree.Element("id")
+            parent.insert(0, id_element)
+        return id_element
+
+    @staticmethod
+    def get_name(element):
+        """Return the name of an object."""
+        return element.findtext("name") or element.findtext("general/name")
+
+    def respond(self, method, path, body):
+        """Return the status and content of the response to a request."""
+        time.sleep(self.latency)
+        path = unquote(path)
+        if not path.startswith("/s3/"):
+            path = path.split("?")[0]
+        with self.lock:
+            self.requests.append((method, path, len(body)))
+            for failure in self.failures:
+                if failure[0] == method and failure[1].search(path) and failure[3]:
+                    failure[3] -= 1
+                    return failure[2], b"<error>Injected failure</error>"
+
+        if path.startswith("/s3/"):
+            return self.respond_s3(method, path, body)
+        parts = path.split("JSSResource/", 1)[-1].split("/")
+        if parts[0] == "fileuploads":
+            return self.upload_icon(int(parts[3]), body)
+        if parts[0] not in ENDPOINTS:
+            return 404, b"<error>Not Found</error>"
+        list_tag = ENDPOINTS[parts[0]][0]
+        objects = self.objects[parts[0]]
+
+        if len(parts) == 1:
+            if method != "GET":
+                return 405, b""
+            listing = ElementTree.Element(list_tag)
+            ElementTree.SubElement(listing, "size").text = str(len(objects))
+            for id_, element in sorted(objects.items()):
+                item = ElementTree.SubElement(listing, ENDPOINTS[parts[0]][1])
+                ElementTree.SubElement(item, "id").text = str(id_)
+                ElementTree.SubElement(item, "name").text = self.get_name(element)
+            return 200, ElementTree.tostring(listing)
+
+        key, value = parts[1], "/".join(parts[2:])
+        if method == "POST":
+            if value != "0":
+                return 409, b"<error>Conflict</error>"
+            element = self.add(parts[0], body)
+            return 201, self.id_response(parts[0], element)
+
+        with self.lock:
+            element = None
+            for id_, candidate in objects.items():
+                if key == "id" and str(id_) == value:
+                    element = candidate
+                elif key == "name" and self.get_name(candidate) == value:
+                    if time.time() >= self.visible_after[(parts[0], id_)]:
+                        element = candidate
+        if element is None:
+            return 404, b"<error>Not Found</error>"
+        if method == "GET":
+            return 200, ElementTree.tostring(element)
+        if method == "PUT":
+            update = ElementTree.fromstring(body)
+            with self.lock:
+                id_ = self.find_id_element(element).text
+                # The Classic API replaces the top level elements sent.
+                for child in update:
+                    if child.tag == "id":
+                        continue
+                    existing = element.find(child.tag)
+                    if existing is not None:
+                        element.remove(existing)
+                    element.append(child)
+                self.find_id_element(element).text = id_
+                if parts[0] == "policies":
+                    self.resolve_icon(element)
+            return 201, self.id_response(parts[0], element)
+        if method == "DELETE":
+            with self.lock:
+                del objects[int(self.find_id_element(element).text)]
+            return 200, b""
+        return 405, b""
+
+    def respond_s3(self, method, path, body):
+        """Respond to an S3 multipart upload request for /s3/bucket/key."""
+        location, _, query = path[len("/s3/") :].partition("?")
+        key = location.partition("/")[2]
+        params = dict(parse_qsl(query, keep_blank_values=True))
+        with self.lock:
+            if "uploads" in params and method == "GET":
+                listing = ElementTree.Element("ListMultipartUploadsResult")
+                for upload_id, upload in sorted(self.s3_uploads.items()):
+                    item = ElementTree.SubElement(listing, "Upload")
+                    ElementTree.SubElement(item, "Key").text = upload["key"]
+                    ElementTree.SubElement(item, "UploadId").text = upload_id
+                return 200, ElementTree.tostring(listing)
+            if "uploads" in params and method == "POST":
+                upload_id = str(self.next_upload_id)
+                self.next_upload_id += 1
+                self.s3_uploads[upload_id] = {"key": key, "parts": {}}
+                response = ElementTree.Element("InitiateMultipartUploadResult")
+                ElementTree.SubElement(response, "UploadId").text = upload_id
+                return 200, ElementTree.tostring(response)
+            upload = self.s3_uploads.get(params.get("uploadId"))
+            if upload is None or upload["key"] != key:
+                return 404, b"<Error><Code>NoSuchUpload</Code></Error>"
+            if method == "PUT":
+                upload["parts"][int(params["partNumber"])] = body
+                return 200, b""
+            if method == "POST":
+                parts = upload["parts"]
+                self.s3_objects[key] = b"".join(parts[n] for n in sorted(parts))
+                del self.s3_uploads[params["uploadId"]]
+                return 200, b"<CompleteMultipartUploadResult/>"
+        return 405, b""
+
+    def resolve_icon(self, policy):
+        """Fill in the details of a policy's icon, which is set by ID.
+
+        As on Jamf Pro, IDs of icons which don't exist are dropped.
+        """
+        icon_id = policy.findtext("self_service/self_service_icon/id")
+        if policy.find("self_service") is not None:
+            self.set_icon(policy, int(icon_id) if icon_id else None)
+
+    def set_icon(self, policy, icon_id):
+        """Set a policy's icon to the icon with icon_id, if it exists."""
+        self_service = policy.find("self_service")
+        if self_service is None:
+            self_service = ElementTree.SubElement(policy, "self_service")
+        icon = self_service.find("self_service_icon")
+        if icon is not None:
+            self_service.remove(icon)
+        if icon_id in self.icons:
+            icon = ElementTree.SubElement(self_service, "self_service_icon")
+            ElementTree.SubElement(icon, "id").text = str(icon_id)
+            ElementTree.SubElement(icon, "filename").text = self.icons[icon_id]
+            ElementTree.SubElement(icon, "uri").text = "{}/icons/{}".format(
+                self.url, icon_id
+            )
+
+    def id_response(self, endpoint, element):
+        """Return the XML the server responds to a write with."""
+        response = ElementTree.Element(ENDPOINTS[endpoint][1])
+        ElementTree.SubElement(response, "id").text = self.find_id_element(element).text
+        return ElementTree.tostring(response)
+
+    def upload_icon(self, policy_id, body):
+        """Store a Self Service icon uploaded for a policy."""
+        match = re.search(b'filename="([^"]+)"', body)
+        filename = match.group(1).decode("utf-8") if match else "icon.png"
+        with self.lock:
+            policy = self.objects["policies"].get(policy_id)
+            if policy is None:
+                return 404, b"<error>Not Found</error>"
+            icon_id = self.next_icon_id
+            self.next_icon_id += 1
+            self.uploads.append((policy_id, filename, len(body)))
+            self.icons[icon_id] = filename
+            self.set_icon(policy, icon_id)
+        return 201, "<policy><id>{}</id></policy>".format(policy_id).encode("utf-8")
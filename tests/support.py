@@ -0,0 +1,89 @@
+"""Helpers shared by the tests and benchmarks."""
+
+from __future__ import absolute_import
+import os
+import sys
+import types
+from copy import deepcopy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import autopkglib  # pylint: disable=unused-import
+except ImportError:
+    # AutoPkg is only installed on Macs; provide the two names the
+    # processor uses.
+    autopkglib = types.ModuleType("autopkglib")
+
+    class ProcessorError(Exception):
+        """An error which stops the recipe."""
+
+    class Processor(object):
+        """The parts of autopkglib.Processor that JSSImporter uses."""
+
+        def __init__(self, env=None, infile=None, outfile=None):
+            self.env = env
+            self.infile = infile
+            self.outfile = outfile
+
+        def output(self, msg, verbose_level=1):
+            """Print msg if the env is verbose enough."""
+            if verbose_level <= self.env.get("verbose", 0):
+                print(msg)
+
+    autopkglib.Processor = Processor
+    autopkglib.ProcessorError = ProcessorError
+    sys.modules["autopkglib"] = autopkglib
+
+import JSSImporter as jssimporter  # pylint: disable=wrong-import-position
+
+EXAMPLE_TEMPLATES = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "example_templates"
+)
+
+
+def build_env(url, root, **overrides):
+    """Return a recipe env for a Jamf Pro server at url.
+
+    The package is a flat file copied to a Local repo, and the recipe
+    folder holds the example templates, all in the folder root.
+    """
+    repo = os.path.join(root, "repo")
+    recipe_dir = os.path.join(root, "recipe")
+    pkg_path = os.path.join(root, "Example-1.0.pkg")
+    if not os.path.isdir(recipe_dir):
+        os.makedirs(os.path.join(repo, "Packages"))
+        os.makedirs(recipe_dir)
+        for name in os.listdir(EXAMPLE_TEMPLATES):
+            with open(os.path.join(EXAMPLE_TEMPLATES, name)) as template:
+                with open(os.path.join(recipe_dir, name), "w") as copy:
+                    copy.write(template.read())
+        with open(pkg_path, "wb") as pkg:
+            pkg.write(b"package contents" * 1024)
+
+    env = {
+        key: deepcopy(value["default"])
+        for key, value in jssimporter.JSSImporter.input_variables.items()
+        if "default" in value
+    }
+    env.update(
+        {
+            "JSS_URL": url,
+            "API_USERNAME": "user",
+            "API_PASSWORD": "password",
+            "JSS_VERIFY_SSL": False,
+            "JSS_REPOS": [{"type": "Local", "mount_point": repo, "share_name": "repo"}],
+            "NAME": "Example",
+            "RECIPE_DIR": recipe_dir,
+            "PARENT_RECIPES": [],
+            "prod_name": "Example",
+            "version": "1.0",
+            "pkg_path": pkg_path,
+            "category": "Productivity",
+            "policy_category": "Testing",
+            "policy_template": "PolicyTemplate.xml",
+            "verbose": 0,
+        }
+    )
+    env.update(overrides)
+    return env
@@ -0,0 +1,857 @@
+"""End to end tests of JSSImporter against a FakeJamf server."""
+
+from __future__ import absolute_import
+import hashlib
+import json
+import os
+import re
+import time
+import zipfile
+from xml.etree import ElementTree
+
+import pytest
+import requests
+
+import JSSImporter as jssimporter
+from fake_jamf import FakeJamf
+from support import EXAMPLE_TEMPLATES
+
+from autopkglib import ProcessorError
+
+
+def writes(server):
+    """Return the write requests the server has received."""
+    return [request for request in server.requests if request[0] in ("POST", "PUT")]
+
+
+def test_first_run_creates_objects_and_copies_package(run, server, make_env):
+    """A first run creates every object and copies the package."""
+    processor = run()
+
+    assert server.get("categories", "Productivity") is not None
+    assert server.get("categories", "Testing") is not None
+    package = server.get("packages", "Example-1.0.pkg")
+    assert package.findtext("category") == "Productivity"
+    policy = server.get("policies", "Install Latest Example")
+    assert policy.findtext("package_configuration/packages/package/name") == (
+        "Example-1.0.pkg"
+    )
+    assert os.path.exists(os.path.join(make_env.repo, "Packages", "Example-1.0.pkg"))
+    # The distribution points are listed before requests are counted.
+    metrics = processor.env["jss_importer_metrics"]
+    assert metrics["requests_total"] == len(server.requests) - 1
+
+
+def test_old_python_jss_is_rejected(run, monkeypatch):
+    """Runs stop if python-jss is older than JSSImporter requires."""
+    monkeypatch.setattr(
+        jssimporter, "REQUIRED_PYTHON_JSS_VERSION", jssimporter.StrictVersion("99.0")
+    )
+
+    with pytest.raises(ProcessorError):
+        run()
+
+
+def test_unchanged_rerun_makes_no_writes(run, server):
+    """Objects which already match their templates are not saved again."""
+    run(STOP_IF_NO_JSS_UPLOAD="False")
+    del server.requests[:]
+
+    processor = run(STOP_IF_NO_JSS_UPLOAD="False")
+
+    assert writes(server) == []
+    assert not processor.env["jss_changed_objects"]["jss_policy_updated"]
+
+
+def test_changed_template_value_updates_policy(run, server):
+    """A changed value in a template is saved with a single PUT."""
+    run(STOP_IF_NO_JSS_UPLOAD="False")
+    del server.requests[:]
+
+    run(STOP_IF_NO_JSS_UPLOAD="False", self_service_description="New")
+
+    assert [request[:2] for request in writes(server)] == [
+        (
+            "PUT",
+            "/JSSResource/policies/id/{}".format(
+                server.get("policies", "Install Latest Example").findtext("general/id")
+            ),
+        )
+    ]
+
+
+# Values which the XML parser changes or rejects when they are in the text.
+AWKWARD_VALUE = 'Line one\r\nLine two\rLine three\n\tIndented & <escaped> "quoted"'
+
+
+def render_both_ways(processor, path, replace_dict):
+    """Return a template rendered from its skeleton and as text."""
+    parts, digest = processor.get_template(path)
+    skeleton = processor.get_template_skeleton(parts, digest)
+    assert skeleton is not None
+    element = processor.render_skeleton(skeleton, replace_dict)[0]
+    text = processor.render_template(parts, replace_dict)[0]
+    return (
+        ElementTree.tostring(element),
+        ElementTree.tostring(ElementTree.fromstring(text.encode("utf-8"))),
+    )
+
+
+@pytest.mark.parametrize("name", sorted(os.listdir(EXAMPLE_TEMPLATES)))
+def test_skeletons_render_like_text(make_env, name):
+    """Parsed templates give values the parser's normalization."""
+    processor = jssimporter.JSSImporter(make_env())
+    path = os.path.join(EXAMPLE_TEMPLATES, name)
+    with open(path) as template:
+        keys = set(re.findall(r"%([A-Za-z_][A-Za-z0-9_]*)%", template.read()))
+    replace_dict = {key: AWKWARD_VALUE for key in keys}
+
+    from_skeleton, from_text = render_both_ways(processor, path, replace_dict)
+
+    assert from_skeleton == from_text
+
+
+def test_skeleton_attributes_render_like_text(make_env, tmp_path):
+    """Whitespace in attribute values is normalized as the parser would."""
+    processor = jssimporter.JSSImporter(make_env())
+    path = tmp_path / "Attribute.xml"
+    path.write_text("<policy><general name='%NAME%'>%NAME%</general></policy>")
+    # Text rendering doesn't escape quotes, so none are used here.
+    replace_dict = {"NAME": AWKWARD_VALUE.replace('"', "")}
+
+    from_skeleton, from_text = render_both_ways(processor, str(path), replace_dict)
+
+    assert from_skeleton == from_text
+
+
+@pytest.mark.parametrize("parsed", [True, False])
+def test_values_not_allowed_in_xml_are_rejected(make_env, monkeypatch, parsed):
+    """Values with characters XML can't hold stop the run either way."""
+    processor = jssimporter.JSSImporter(make_env())
+    if not parsed:
+        monkeypatch.setattr(processor, "get_template_skeleton", lambda *args: None)
+    path = os.path.join(EXAMPLE_TEMPLATES, "PolicyTemplate.xml")
+
+    with pytest.raises(ProcessorError):
+        processor.get_templated_object(
+            jssimporter.jss.Policy, path, {"SELF_SERVICE_DESCRIPTION": "Bell\x07"}
+        )
+
+
+def test_rerun_stops_when_no_upload_is_needed(run, server):
+    """With STOP_IF_NO_JSS_UPLOAD, an existing package ends the run early."""
+    run()
+    del server.requests[:]
+
+    processor = run()
+
+    assert processor.env["stop_processing_recipe"]
+    assert writes(server) == []
+    assert server.count("GET", "policies") == 0
+
+
+def test_file_share_rerun_ignores_stale_package_record_hash(run, server, make_env):
+    """Copies to file shares are checked against, and update, the record hash."""
+    run(JSS_UPLOAD_ON_HASH_CHANGE=True)
+    package = server.get("packages", "Example-1.0.pkg")
+    package.append(ElementTree.fromstring("<hash_type>MD5</hash_type>"))
+    package.append(ElementTree.fromstring("<hash_value>stale</hash_value>"))
+
+    assert run(JSS_UPLOAD_ON_HASH_CHANGE=True).env["stop_processing_recipe"]
+
+    with open(make_env.pkg_path, "wb") as pkg_file:
+        pkg_file.write(b"changed")
+    processor = run(JSS_UPLOAD_ON_HASH_CHANGE=True)
+
+    assert processor.upload_needed
+    assert package.findtext("hash_value") == hashlib.md5(b"changed").hexdigest()
+    assert run(JSS_UPLOAD_ON_HASH_CHANGE=True).env["stop_processing_recipe"]
+
+
+def test_package_hashes_are_recorded_per_server(run, make_env, tmp_path):
+    """An upload to one server doesn't hide a stale package on another."""
+    other = FakeJamf().start()
+    other_repo = tmp_path / "other"
+    (other_repo / "Packages").mkdir(parents=True)
+    other_env = {
+        "JSS_URL": other.url,
+        "JSS_REPOS": [
+            {"type": "Local", "mount_point": str(other_repo), "share_name": "other"}
+        ],
+        "JSS_UPLOAD_ON_HASH_CHANGE": True,
+    }
+    try:
+        run(JSS_UPLOAD_ON_HASH_CHANGE=True)
+        run(**other_env)
+        with open(make_env.pkg_path, "wb") as pkg_file:
+            pkg_file.write(b"changed")
+        run(JSS_UPLOAD_ON_HASH_CHANGE=True)
+
+        assert run(**other_env).upload_needed
+    finally:
+        other.stop()
+    assert (other_repo / "Packages" / "Example-1.0.pkg").read_bytes() == b"changed"
+
+
+def test_wait_for_id_backs_off_until_the_object_appears(make_env, server):
+    """IDs are polled with short, growing delays rather than fixed sleeps."""
+    server.add("packages", "<package><name>Slow.pkg</name></package>", delay=0.3)
+    processor = jssimporter.JSSImporter(
+        make_env(JSS_WAIT_INITIAL_DELAY=0.01, JSS_WAIT_MAX_DELAY=0.1, JSS_WAIT_JITTER=0)
+    )
+    processor.create_jss()
+
+    start = time.time()
+    package = processor.wait_for_id(jssimporter.jss.Package, "Slow.pkg")
+
+    assert package is not None and int(package.id)
+    assert time.time() - start < 1
+    polls = server.count("GET", "packages/name/Slow.pkg")
+    assert 3 <= polls <= 10
+    assert processor.metrics["polling"]["checks"] == polls - 1
+
+
+def test_wait_for_id_gives_up_after_the_timeout(make_env, server):
+    """An object which never appears stops the polling at the timeout."""
+    processor = jssimporter.JSSImporter(
+        make_env(JSS_WAIT_INITIAL_DELAY=0.01, JSS_WAIT_TIMEOUT=0.2)
+    )
+    processor.create_jss()
+
+    start = time.time()
+    assert processor.wait_for_id(jssimporter.jss.Package, "Missing.pkg") is None
+    assert time.time() - start < 1
+
+
+def test_server_errors_are_raised(run, server):
+    """A failed write stops the recipe."""
+    server.fail("POST", "policies")
+
+    with pytest.raises(jssimporter.jss.PostError):
+        run()
+
+
+def test_dry_run_makes_no_writes(run, server, make_env):
+    """A dry run reads from the server, and plans its writes."""
+    processor = run(JSS_DRY_RUN=True)
+
+    assert writes(server) == []
+    assert os.listdir(os.path.join(make_env.repo, "Packages")) == []
+    plan = processor.env["jss_importer_plan"]
+    assert {"type": "Category", "name": "Productivity"} in plan["creates"]
+    assert {"type": "Policy", "name": "Install Latest Example"} in plan["creates"]
+    assert plan["uploads"][0]["name"] == "Example-1.0.pkg"
+    assert plan["bytes_to_upload"] == os.path.getsize(make_env.pkg_path)
+
+
+def test_checkpoint_resumes_an_interrupted_upload(run, server, make_env, tmp_path):
+    """Only the distribution points which missed a copy receive it again."""
+    second_repo = tmp_path / "second"
+    second_repo.mkdir()
+    repos = make_env()["JSS_REPOS"] + [
+        {"type": "Local", "mount_point": str(second_repo), "share_name": "second"}
+    ]
+
+    # The second repo has no Packages folder, so copying to it fails.
+    with pytest.raises(ProcessorError):
+        run(JSS_REPOS=repos, JSS_UPLOAD_CHECKPOINT=True)
+    checkpoint_path = os.path.join(jssimporter.STATE_DIR, "upload_checkpoint.json")
+    with open(checkpoint_path) as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+    assert list(checkpoint.values()) == [["local://" + make_env.repo]]
+
+    first_copy = os.path.join(make_env.repo, "Packages", "Example-1.0.pkg")
+    os.remove(first_copy)
+    (second_repo / "Packages").mkdir()
+    run(JSS_REPOS=repos, JSS_UPLOAD_CHECKPOINT=True)
+
+    assert not os.path.exists(first_copy)
+    assert (second_repo / "Packages" / "Example-1.0.pkg").exists()
+    with open(checkpoint_path) as checkpoint_file:
+        assert json.load(checkpoint_file) == {}
+
+
+class FakeBucket(object):
+    """The parts of a boto S3 Bucket used for multipart uploads, on a FakeJamf."""
+
+    def __init__(self, server, name="jamf"):
+        self.url = "{}/s3/{}".format(server.url, name)
+        self.name = name
+
+    def __repr__(self):
+        return "<Bucket: {}>".format(self.name)
+
+    def initiate_multipart_upload(self, key_name, metadata=None):
+        """Start a multipart upload."""
+        response = requests.post("{}/{}?uploads".format(self.url, key_name))
+        response.raise_for_status()
+        upload_id = ElementTree.fromstring(response.content).findtext("UploadId")
+        return FakeMultiPartUpload(self, key_name, upload_id)
+
+    def list_multipart_uploads(self):
+        """Return the multipart uploads which have not been completed."""
+        response = requests.get("{}?uploads".format(self.url))
+        response.raise_for_status()
+        return [
+            FakeMultiPartUpload(
+                self, upload.findtext("Key"), upload.findtext("UploadId")
+            )
+            for upload in ElementTree.fromstring(response.content).iter("Upload")
+        ]
+
+
+class FakeMultiPartUpload(object):
+    """The parts of a boto MultiPartUpload used by JSSImporter."""
+
+    def __init__(self, bucket, key_name, upload_id):
+        self.url = "{}/{}".format(bucket.url, key_name)
+        self.id = upload_id  # pylint: disable=invalid-name
+
+    def upload_part_from_file(self, fp, part_num, size=None):
+        """Upload size bytes from fp as part part_num."""
+        response = requests.put(
+            "{}?partNumber={}&uploadId={}".format(self.url, part_num, self.id),
+            data=fp.read(size),
+        )
+        response.raise_for_status()
+
+    def complete_upload(self):
+        """Join the uploaded parts into the object."""
+        response = requests.post("{}?uploadId={}".format(self.url, self.id))
+        response.raise_for_status()
+
+
+class FakeAWS(jssimporter.jss.distribution_point.AWS):
+    """An AWS distribution point whose bucket is a FakeBucket."""
+
+    def __init__(self, bucket):  # pylint: disable=super-init-not-called
+        self.connection = {"url": bucket}
+        self.bucket = bucket
+
+    def copy_pkg(self, filename, id_=-1):
+        """Upload in a single request, as python-jss does."""
+        raise AssertionError("Uploaded without JSS_UPLOAD_CHUNK_SIZE")
+
+
+@pytest.fixture
+def bucket(server, monkeypatch):
+    """A FakeBucket added to the distribution points of every session."""
+    fake_bucket = FakeBucket(server)
+    create_jss = jssimporter.JSSImporter.create_jss
+
+    def create_jss_with_bucket(self):
+        create_jss(self)
+        self.jss.distribution_points._children.append(FakeAWS(fake_bucket))
+
+    monkeypatch.setattr(jssimporter.JSSImporter, "create_jss", create_jss_with_bucket)
+    return fake_bucket
+
+
+def upload_to_bucket(make_env, **overrides):
+    """Copy the package to the distribution points in parts."""
+    overrides.setdefault("JSS_UPLOAD_CHUNK_SIZE", jssimporter.MIN_UPLOAD_CHUNK_SIZE)
+    processor = jssimporter.JSSImporter(make_env(**overrides))
+    processor.init_jss_changed_objects()
+    processor.create_jss()
+    processor.copy(make_env.pkg_path)
+
+
+def part_uploads(server):
+    """Return the part numbers uploaded to the FakeBucket, in order."""
+    return [
+        int(re.search(r"partNumber=(\d+)", request[1]).group(1))
+        for request in server.requests
+        if request[0] == "PUT" and request[1].startswith("/s3/")
+    ]
+
+
+@pytest.fixture
+def large_package(make_env):
+    """Make the package two and a half parts long."""
+    content = os.urandom(jssimporter.MIN_UPLOAD_CHUNK_SIZE * 5 // 2)
+    with open(make_env.pkg_path, "wb") as pkg:
+        pkg.write(content)
+    return content
+
+
+def test_interrupted_multipart_upload_resumes_with_missing_parts(
+    make_env, server, bucket, large_package
+):
+    """The next run only sends the parts the bucket hasn't acknowledged."""
+    server.fail("PUT", "partNumber=3&")
+
+    with pytest.raises(ProcessorError):
+        upload_to_bucket(make_env, JSS_UPLOAD_CHECKPOINT=True)
+    assert server.s3_objects == {}
+    del server.requests[:]
+
+    upload_to_bucket(make_env, JSS_UPLOAD_CHECKPOINT=True)
+
+    assert part_uploads(server) == [3]
+    assert server.s3_objects == {"Example-1.0.pkg": large_package}
+    with open(os.path.join(jssimporter.STATE_DIR, "upload_parts.json")) as parts:
+        assert json.load(parts) == {}
+
+
+def test_multipart_upload_retries_only_failed_parts(
+    make_env, server, bucket, large_package
+):
+    """A retried upload resumes within the run, with parts sent concurrently."""
+    server.fail("PUT", "partNumber=2&")
+
+    upload_to_bucket(
+        make_env,
+        JSS_UPLOAD_RETRIES=1,
+        JSS_WAIT_INITIAL_DELAY=0,
+        JSS_UPLOAD_PART_CONCURRENCY=3,
+    )
+
+    assert sorted(part_uploads(server)) == [1, 2, 2, 3]
+    assert server.s3_objects == {"Example-1.0.pkg": large_package}
+    assert server.s3_uploads == {}
+
+
+def test_multipart_upload_rejects_parts_too_small_for_s3(make_env, bucket):
+    """S3 needs parts of at least 5 MiB."""
+    with pytest.raises(ProcessorError):
+        upload_to_bucket(make_env, JSS_UPLOAD_CHUNK_SIZE=1024)
+
+
+@pytest.fixture
+def bundle(tmp_path):
+    """A bundle package with a few files."""
+    resources = tmp_path / "Bundle.pkg" / "Contents" / "Resources"
+    resources.mkdir(parents=True)
+    for index in range(3):
+        (resources / "file{}".format(index)).write_bytes(b"content" * 100)
+    return str(tmp_path / "Bundle.pkg")
+
+
+def test_zip_reuses_unchanged_bundles(make_env, bundle):
+    """With JSS_ZIP_REUSE, an unchanged bundle's zip isn't made again."""
+    processor = jssimporter.JSSImporter(make_env())
+    zip_name = processor.zip_pkg_path(bundle)
+    os.utime(zip_name, (0, 0))
+
+    assert processor.zip_pkg_path(bundle) == zip_name
+    assert os.path.getmtime(zip_name) == 0
+
+
+def test_zip_skips_the_fingerprint_without_reuse(make_env, bundle, monkeypatch):
+    """Without JSS_ZIP_REUSE, the bundle is only read to zip it."""
+    processor = jssimporter.JSSImporter(make_env(JSS_ZIP_REUSE=False))
+    monkeypatch.setattr(processor, "get_bundle_fingerprint", None)
+    zip_name = processor.zip_pkg_path(bundle)
+    os.utime(zip_name, (0, 0))
+
+    processor.zip_pkg_path(bundle)
+
+    assert os.path.getmtime(zip_name) != 0
+
+
+def test_zip_remakes_bundles_zipped_with_other_compression(make_env, bundle):
+    """A zip made with other compression settings isn't reused."""
+    jssimporter.JSSImporter(make_env(JSS_ZIP_COMPRESSION="9")).zip_pkg_path(bundle)
+
+    processor = jssimporter.JSSImporter(make_env(JSS_ZIP_COMPRESSION="store"))
+    zip_name = processor.zip_pkg_path(bundle)
+
+    with zipfile.ZipFile(zip_name) as zip_handle:
+        assert {info.compress_type for info in zip_handle.infolist()} == {
+            zipfile.ZIP_STORED
+        }
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_zip_compresses_members_in_parallel(make_env, bundle, workers):
+    """Zips made by several workers hold the same files as ZipFile.write."""
+    with open(os.path.join(bundle, "Contents", "large"), "wb") as large:
+        large.write(os.urandom(3 * 1024 * 1024) * 2)
+    processor = jssimporter.JSSImporter(
+        make_env(JSS_ZIP_WORKERS=workers, JSS_ZIP_COMPRESSION="1")
+    )
+
+    zip_name = processor.zip_pkg_path(bundle)
+
+    with zipfile.ZipFile(zip_name) as zip_handle:
+        assert zip_handle.testzip() is None
+        assert sorted(zip_handle.namelist()) == sorted(
+            os.path.relpath(os.path.join(root, name), "/")
+            for root, _, files in os.walk(bundle)
+            for name in files
+        )
+        for info in zip_handle.infolist():
+            assert info.compress_type == zipfile.ZIP_DEFLATED
+            with open(os.path.join("/", info.filename), "rb") as member:
+                assert zip_handle.read(info) == member.read()
+
+
+@pytest.mark.parametrize("compression", ["fast", "10", "-1"])
+def test_zip_rejects_invalid_compression(make_env, bundle, compression):
+    """JSS_ZIP_COMPRESSION must be 'store' or a level from 0 to 9."""
+    processor = jssimporter.JSSImporter(make_env(JSS_ZIP_COMPRESSION=compression))
+
+    with pytest.raises(ProcessorError):
+        processor.zip_pkg_path(bundle)
+
+
+def xml_contains(wanted, existing):
+    """Compare two XML strings as JSSImporter compares objects."""
+    processor = jssimporter.JSSImporter({})
+    return processor.xml_contains(
+        jssimporter.ElementTree.fromstring(wanted),
+        jssimporter.ElementTree.fromstring(existing),
+    )
+
+
+SELF_SERVICE = (
+    "<policy><self_service><self_service_categories>{}"
+    "</self_service_categories></self_service></policy>"
+)
+CATEGORY = (
+    "<category><id>{0}</id><name>{1}</name><display_in>true</display_in></category>"
+)
+POPUP = (
+    "<computer_extension_attribute><input_type><type>Pop-up Menu</type>"
+    "<popup_choices>{}</popup_choices></input_type></computer_extension_attribute>"
+)
+
+
+def self_service(*names):
+    """Return policy XML with Self Service categories."""
+    return SELF_SERVICE.format(
+        "".join(CATEGORY.format(index, name) for index, name in enumerate(names))
+    )
+
+
+def popup(*choices):
+    """Return extension attribute XML with pop-up menu choices."""
+    return POPUP.format("".join("<choice>{}</choice>".format(c) for c in choices))
+
+
+def test_xml_contains_ignores_server_fields_and_order():
+    """Reordered list members and fields set by the server still match."""
+    assert xml_contains(self_service("B", "A"), self_service("A", "B"))
+    assert xml_contains(popup("2", "1"), popup("1", "2"))
+    assert xml_contains(
+        "<policy><general><name>P</name></general></policy>",
+        "<policy><general><id>4</id><name>P</name><enabled>true</enabled>"
+        "</general></policy>",
+    )
+
+
+def test_xml_contains_detects_removed_list_members():
+    """A list member missing from the template must be removed by a save."""
+    assert not xml_contains(self_service("A"), self_service("A", "B"))
+    assert not xml_contains(popup("1"), popup("1", "2"))
+    assert not xml_contains(
+        "<computer_group><criteria><criterion><name>A</name></criterion>"
+        "</criteria></computer_group>",
+        "<computer_group><criteria><criterion><name>A</name></criterion>"
+        "<criterion><name>B</name></criterion></criteria></computer_group>",
+    )
+
+
+def test_xml_contains_detects_added_and_changed_list_members():
+    """New and changed list members must be saved."""
+    assert not xml_contains(self_service("A", "B"), self_service("A"))
+    assert not xml_contains(popup("1", "3"), popup("1", "2"))
+    assert not xml_contains(popup("1", "1"), popup("1", "2"))
+
+
+class MountableRepository(jssimporter.jss.distribution_point.LocalRepository):
+    """A Local repo which records being mounted and unmounted, like a file share."""
+
+    def __init__(self, mounted=False, **connection_args):
+        super(MountableRepository, self).__init__(**connection_args)
+        self.mounted = mounted
+        self.events = []
+
+    def is_mounted(self):
+        """Return whether the share is mounted."""
+        return self.mounted
+
+    def mount(self):
+        """Mount the share, if it isn't already."""
+        if not self.mounted:
+            self.events.append("mount")
+            self.mounted = True
+
+    def umount(self, forced=True):
+        """Unmount the share."""
+        self.events.append("umount")
+        self.mounted = False
+
+    def copy_pkg(self, filename, id_=-1):
+        """Copy a package, which needs the share to be mounted."""
+        assert self.mounted
+        self.events.append("copy")
+        super(MountableRepository, self).copy_pkg(filename, id_)
+
+
+@pytest.fixture
+def share(tmp_path, monkeypatch):
+    """A file share added to the distribution points of every session."""
+    (tmp_path / "share" / "Packages").mkdir(parents=True)
+    repository = MountableRepository(
+        mount_point=str(tmp_path / "share"), share_name="share"
+    )
+    create_jss = jssimporter.JSSImporter.create_jss
+
+    def create_jss_with_share(self):
+        create_jss(self)
+        children = self.jss.distribution_points._children
+        if repository not in children:
+            children.append(repository)
+
+    monkeypatch.setattr(jssimporter.JSSImporter, "create_jss", create_jss_with_share)
+    return repository
+
+
+def test_run_mounts_and_unmounts_shares(run, share):
+    """A share is mounted for a run, and unmounted after it."""
+    run()
+
+    assert share.events == ["mount", "copy", "umount"]
+
+
+def test_run_leaves_mounted_shares_mounted(run, share):
+    """A share which was already mounted stays mounted."""
+    share.mounted = True
+
+    run()
+
+    assert share.events == ["copy"]
+    assert share.mounted
+
+
+def batch_envs(make_env, **overrides):
+    """Return the envs of three recipes, each with its own package."""
+    envs = []
+    for name in ("First", "Second", "Third"):
+        env = make_env(NAME=name, prod_name=name, **overrides)
+        pkg_path = env["pkg_path"].replace("Example", name)
+        with open(pkg_path, "wb") as pkg:
+            pkg.write(name.encode("utf-8"))
+        env["pkg_path"] = pkg_path
+        envs.append(env)
+    return envs
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_batch_mounts_shares_once(make_env, share, max_workers):
+    """Recipes in a batch share one mount, alongside a repo which isn't mounted."""
+    results = jssimporter.JSSImporter.run_batch(
+        batch_envs(make_env), max_workers=max_workers
+    )
+
+    assert [env.get("jss_importer_error") for env in results] == [None] * 3
+    assert share.events == ["mount", "copy", "copy", "copy", "umount"]
+
+
+def test_batch_recipes_keep_the_session_they_were_mounted_for(
+    make_env, tmp_path, monkeypatch
+):
+    """Recipes don't replace an expired batch session with an unmounted one."""
+    (tmp_path / "share" / "Packages").mkdir(parents=True)
+    shares = []
+    create_jss = jssimporter.JSSImporter.create_jss
+
+    def create_jss_with_share(self):
+        create_jss(self)
+        # Each session has its own distribution point objects.
+        shares.append(
+            MountableRepository(mount_point=str(tmp_path / "share"), share_name="share")
+        )
+        self.jss.distribution_points._children.append(shares[-1])
+
+    monkeypatch.setattr(jssimporter.JSSImporter, "create_jss", create_jss_with_share)
+
+    results = jssimporter.JSSImporter.run_batch(
+        batch_envs(make_env, JSS_SESSION_MAX_AGE=0)
+    )
+
+    assert [env.get("jss_importer_error") for env in results] == [None] * 3
+    assert [share.events for share in shares] == [["mount", "copy", "umount"]] * 3
+
+
+def test_dry_run_leaves_local_state_and_caches_alone(run, server, make_env):
+    """Objects a dry run would create aren't taken to exist by later runs."""
+    manifest = os.path.join(jssimporter.STATE_DIR, "package_hashes.json")
+
+    run(JSS_DRY_RUN=True, JSS_UPLOAD_ON_HASH_CHANGE=True, JSS_REUSE_SESSION=True)
+
+    assert not os.path.exists(manifest)
+    categories = jssimporter.INVENTORY_CACHE[(server.url, "Category")][1]
+    assert "productivity" not in categories
+
+    run(JSS_UPLOAD_ON_HASH_CHANGE=True, JSS_REUSE_SESSION=True)
+
+    assert server.get("categories", "Productivity") is not None
+    assert os.path.exists(manifest)
+
+
+def test_state_cache_skips_unchanged_recipes(run, server):
+    """A recipe whose inputs are unchanged doesn't connect to the server."""
+    run(JSS_STATE_CACHE=True)
+    del server.requests[:]
+
+    processor = run(JSS_STATE_CACHE=True)
+
+    assert server.requests == []
+    assert processor.env["stop_processing_recipe"]
+
+
+def test_early_stop_refreshes_recipe_state(run, server):
+    """A verification run which stops early postpones the next one."""
+    state_path = os.path.join(jssimporter.STATE_DIR, "recipe_state.json")
+    run(JSS_STATE_CACHE=True, JSS_STATE_VERIFY_INTERVAL=1)
+    with open(state_path) as state_file:
+        first = json.load(state_file)["Example"]
+    time.sleep(1)
+
+    run(JSS_STATE_CACHE=True, JSS_STATE_VERIFY_INTERVAL=1)
+
+    with open(state_path) as state_file:
+        second = json.load(state_file)["Example"]
+    assert second["verified"] > first["verified"]
+    assert second["ids"] == first["ids"]
+    del server.requests[:]
+    run(JSS_STATE_CACHE=True, JSS_STATE_VERIFY_INTERVAL=1)
+    assert server.requests == []
+
+
+def test_icon_registry_reuses_renamed_icons_without_rewriting(run, server, make_env):
+    """A reused icon keeps its uploaded name, and is matched by ID."""
+    for name in ("first.png", "second.png"):
+        with open(os.path.join(make_env.recipe_dir, name), "wb") as icon:
+            icon.write(b"the same icon")
+    first = {"self_service_icon": "first.png", "JSS_ICON_REGISTRY": True}
+    # The package is already uploaded when the second recipe runs.
+    second = dict(
+        first,
+        self_service_icon="second.png",
+        prod_name="Second",
+        STOP_IF_NO_JSS_UPLOAD="False",
+    )
+
+    run(**first)
+    run(**second)
+
+    assert len(server.uploads) == 1
+    policy = server.get("policies", "Install Latest Second")
+    assert policy.findtext("self_service/self_service_icon/filename") == "first.png"
+    del server.requests[:]
+
+    run(**second)
+
+    assert len(server.uploads) == 1
+    assert writes(server) == []
+
+
+@pytest.mark.parametrize("backend", ["threads", "asyncio"])
+def test_concurrent_backends_create_policy_objects(run, server, backend):
+    """Extension attributes and groups are created by either backend."""
+    processor = run(
+        JSS_OBJECT_CONCURRENCY=2,
+        JSS_EXECUTION_BACKEND=backend,
+        extension_attributes=[{"ext_attribute_path": "ExtensionAttribute.xml"}],
+        groups=[
+            {"name": name, "smart": True, "template_path": "SmartGroupTemplate.xml"}
+            for name in ("First", "Second", "Third")
+        ],
+    )
+
+    assert server.get("computerextensionattributes", "Example Extension Attribute")
+    assert [group.name for group in processor.groups] == ["First", "Second", "Third"]
+    for name in ("First", "Second", "Third"):
+        assert server.get("computergroups", name) is not None
+
+
+@pytest.mark.parametrize("backend", ["threads", "asyncio"])
+def test_concurrent_backends_limit_and_order_work(make_env, backend):
+    """At most JSS_OBJECT_CONCURRENCY objects are handled at once."""
+    processor = jssimporter.JSSImporter(
+        make_env(
+            JSS_OBJECT_CONCURRENCY=2,
+            JSS_EXECUTION_BACKEND=backend,
+            extension_attributes=["ea1", "ea2", "ea3"],
+            groups=[{"name": "group1"}, {"name": "group2"}],
+            scripts=["script1", "script2"],
+        )
+    )
+    events = []
+    active = []
+
+    def handle(item):
+        """Record the item being handled, and how many are in progress."""
+        item = item["name"] if isinstance(item, dict) else item
+        active.append(item)
+        events.append((item, len(active)))
+        time.sleep(0.05)
+        active.remove(item)
+        return item
+
+    processor.handle_extension_attribute = handle
+    processor.handle_group = handle
+    processor.handle_script = handle
+    processor.handle_policy_objects()
+
+    assert processor.extattrs == ["ea1", "ea2", "ea3"]
+    assert processor.groups == ["group1", "group2"]
+    assert processor.scripts == ["script1", "script2"]
+    assert max(count for _, count in events) == 2
+    started = [item for item, _ in events]
+    assert started.index("group1") > started.index("ea3")
+
+
+@pytest.mark.parametrize("backend", ["threads", "asyncio"])
+def test_concurrent_backends_finish_work_before_raising(make_env, backend):
+    """A failed object is raised once the others in progress are done."""
+    processor = jssimporter.JSSImporter(
+        make_env(
+            JSS_OBJECT_CONCURRENCY=2,
+            JSS_EXECUTION_BACKEND=backend,
+            extension_attributes=["bad", "slow"],
+        )
+    )
+    finished = []
+
+    def handle(item):
+        """Fail for 'bad', and take a while for anything else."""
+        if item == "bad":
+            raise ProcessorError("bad extension attribute")
+        time.sleep(0.1)
+        finished.append(item)
+
+    processor.handle_extension_attribute = handle
+
+    with pytest.raises(ProcessorError):
+        processor.handle_policy_objects()
+    assert finished == ["slow"]
+
+
+def test_icon_registry_only_records_uploaded_icons(run, server, make_env):
+    """An icon found on a policy by name isn't taken to have new content."""
+    icon_path = os.path.join(make_env.recipe_dir, "icon.png")
+    with open(icon_path, "wb") as icon:
+        icon.write(b"old icon")
+    run(self_service_icon="icon.png")
+    with open(icon_path, "wb") as icon:
+        icon.write(b"new icon")
+    with open(os.path.join(make_env.recipe_dir, "other.png"), "wb") as icon:
+        icon.write(b"new icon")
+
+    run(
+        self_service_icon="icon.png",
+        JSS_ICON_REGISTRY=True,
+        STOP_IF_NO_JSS_UPLOAD="False",
+    )
+    run(
+        self_service_icon="other.png",
+        JSS_ICON_REGISTRY=True,
+        prod_name="Other",
+        STOP_IF_NO_JSS_UPLOAD="False",
+    )
+
+    assert [upload[1] for upload in server.uploads] == ["icon.png", "other.png"]